@@ -2,8 +2,19 @@ import sys
 import getopt
 import re
 import json
+import mmap
+import multiprocessing
+import resource
+import time
+from array import array
+from collections import OrderedDict
 from pprint import pprint
 
+try:
+    import numpy
+except ImportError:
+    numpy = None    # batch testing falls back to plain loops
+
 """
 DFA/NFA Processor
 
@@ -16,15 +27,54 @@ Updated: 2/20/15
 # define global variables
 verbose = False
 strict = True
+regex_cache_size = 128
+
+
+class ProductOperators(object):
+    """
+    Boolean operations on machines, each building a lazy ProductDFA:
+    a & b (intersection), a | b (union), a - b (difference) and ~a (complement).
+    """
+    def __and__(self, other):
+        return ProductDFA([self, other], lambda accepted: accepted[0] and accepted[1])
+
+    def __or__(self, other):
+        return ProductDFA([self, other], lambda accepted: accepted[0] or accepted[1])
+
+    def __sub__(self, other):
+        return ProductDFA([self, other], lambda accepted: accepted[0] and not accepted[1])
 
+    def __invert__(self):
+        return ProductDFA([self], lambda accepted: not accepted[0])
 
-class DFA(object):
+
+class DFA(ProductOperators):
     def __init__(self):
         self.states = list()
         self.input_symbols = list()
         self.delta_transition_table = list()
         self.start_state = None
         self.accepting_states = list()
+        self.compiled = None
+
+    def compile(self):
+        """
+        Intern the states and symbols into a flat integer transition table used by test_tape.
+        The dict delta table stays the authoring format, so call this again after editing it.
+        :return: The CompiledDFA for this machine.
+        """
+        self.compiled = CompiledDFA(self)
+        return self.compiled
+
+    def get_compiled(self):
+        # compile on first use
+        if self.compiled is None:
+            self.compile()
+        return self.compiled
+
+    def get_compiled_dfa(self):
+        # the deterministic table used by the batch, byte, parallel and minimization methods
+        return self.get_compiled()
 
     def get_end_state(self, start_state, transition):
         try:
@@ -33,15 +83,278 @@ class DFA(object):
             return None
 
     def test_tape(self, transitions):
-        current_state = self.start_state
-        for transition in transitions:
-            if verbose:
-                print current_state, "-"+str(transition)+"->",
-            current_state = self.delta_transition_table[current_state][str(transition)][0]
         if verbose:
+            # trace the tape through the dict table so states are printed by name
+            current_state = self.start_state
+            for transition in transitions:
+                print current_state, "-"+str(transition)+"->",
+                current_state = self.delta_transition_table[current_state][str(transition)][0]
             print current_state
 
-        return current_state in self.accepting_states
+            return current_state in self.accepting_states
+
+        return self.get_compiled().accepts(transitions)
+
+    def test_tapes(self, batch):
+        """
+        Test a batch of tapes against the DFA at once.
+        :param batch: List of tapes (each a list of symbols or a string of tape characters).
+        :return: Boolean array of results in batch order (a list of bools if NumPy is not installed).
+        """
+        return self.get_compiled_dfa().accepts_all(batch)
+
+    def test_tape_parallel(self, transitions, processes=None, chunk_size=None):
+        """
+        Test one long tape by splitting it into chunks across a process pool.
+        Each chunk is run from every state at once, giving a state -> state mapping per chunk,
+        and the mappings are composed in tape order starting from the start state.
+        :param transitions: Tape as a list of symbols or a string of tape characters.
+        :param processes: Pool size, the number of cores by default.
+        :param chunk_size: Symbols per chunk, by default the tape is split in four chunks per process.
+        :return: True if the tape is accepted.
+        """
+        compiled = self.get_compiled_dfa()
+        if processes is None:
+            processes = multiprocessing.cpu_count()
+        if chunk_size is None:
+            chunk_size = max(len(transitions) // (processes * 4), 1)
+        if processes < 2 or len(transitions) <= chunk_size:
+            return compiled.accepts(transitions)
+
+        chunks = (transitions[i:i + chunk_size] for i in xrange(0, len(transitions), chunk_size))
+        pool = multiprocessing.Pool(processes, _init_chunk_worker, (compiled,))
+        try:
+            current_state = compiled.start
+            for mapping in pool.imap(_map_chunk, chunks):
+                current_state = mapping[current_state]
+        finally:
+            pool.terminate()
+
+        return compiled.accepting[current_state] == 1
+
+    def test_bytes(self, data, ignore=" \t\r\n"):
+        """
+        Test a raw byte tape, each byte is the tape character of one symbol.
+        :param data: str, bytearray, buffer or mmap holding the tape.
+        :param ignore: Bytes skipped on the tape (line breaks in tape files), as in DFAMatcher.
+        """
+        compiled = self.get_compiled_dfa()
+        return compiled.accepting[compiled.run_bytes(data, ignore=ignore)] == 1
+
+    def test_file(self, filename, ignore=" \t\r\n"):
+        """
+        Test the raw bytes of a file as the tape, the file is memory mapped rather than read.
+        Whitespace is skipped by default, so this agrees with test_tape_file.
+        """
+        tape_file = open(filename, "rb")
+        try:
+            try:
+                data = mmap.mmap(tape_file.fileno(), 0, access=mmap.ACCESS_READ)
+            except ValueError:
+                # empty files can not be mapped
+                return self.test_bytes("", ignore)
+            try:
+                return self.test_bytes(data, ignore)
+            finally:
+                data.close()
+        finally:
+            tape_file.close()
+
+    def equivalent(self, other):
+        """
+        Check whether another DFA accepts the same language, using Hopcroft and Karp's union-find
+        over the pairs of states of the two machines, explored breadth first.
+        Symbols missing from one of the alphabets lead to that machine's dead state.
+        :return: (True, None) if the languages are equal, otherwise (False, tape) with the shortest
+                 tape accepted by exactly one of the two machines.
+        """
+        left = self.get_compiled_dfa()
+        right = other.get_compiled_dfa()
+        symbols = list(left.symbols) + [s for s in right.symbols if str(s) not in left.symbol_index]
+        columns = [(left.symbol_index.get(str(s)), right.symbol_index.get(str(s))) for s in symbols]
+
+        # the right machine's state ids are offset past the left machine's in the union-find
+        offset = left.dead_state + 1
+        parent = range(offset + right.dead_state + 1)
+
+        def find(s):
+            root = s
+            while parent[root] != root:
+                root = parent[root]
+            while parent[s] != root:
+                parent[s], s = root, parent[s]
+            return root
+
+        if left.accepting[left.start] != right.accepting[right.start]:
+            return False, []
+        parent[right.start + offset] = left.start
+
+        # breadth first queue of pairs, with parent pointers to read back the tape
+        queue = [(left.start, right.start)]
+        came_from = [(-1, None)]
+        for i, (p, q) in enumerate(queue):
+            for j, (a, b) in enumerate(columns):
+                r = left.dead_state if a is None else left.table[p * left.width + a]
+                s = right.dead_state if b is None else right.table[q * right.width + b]
+                x = find(r)
+                y = find(s + offset)
+                if x == y:
+                    continue
+                parent[max(x, y)] = min(x, y)
+                queue.append((r, s))
+                came_from.append((i, j))
+
+                if left.accepting[r] != right.accepting[s]:
+                    tape = []
+                    k = len(queue) - 1
+                    while came_from[k][0] != -1:
+                        k, j = came_from[k]
+                        tape.append(symbols[j])
+                    tape.reverse()
+                    return False, tape
+
+        return True, None
+
+    def minimize(self):
+        """
+        Minimize the DFA with Hopcroft's partition refinement algorithm.
+        Unreachable states are dropped, and each state of the result is named after the first
+        original state (in the order of self.states) that it stands for.
+        :return: A new, minimal DFA.
+        """
+        compiled = self.get_compiled_dfa()
+        table = compiled.table
+        width = compiled.width
+        reachable = compiled.reachable_states()
+
+        # inverse transition index: for each symbol, the predecessors of every state
+        inverse = [[[] for _ in xrange(compiled.dead_state + 1)] for _ in xrange(width)]
+        for s in reachable:
+            for c in xrange(width):
+                inverse[c][table[s * width + c]].append(s)
+
+        accepting = set(s for s in reachable if compiled.accepting[s])
+        blocks = [b for b in (accepting, set(reachable) - accepting) if b]
+        block_of = [-1] * (compiled.dead_state + 1)
+        for i, block in enumerate(blocks):
+            for s in block:
+                block_of[s] = i
+
+        # worklist of splitters (block, symbol), starting from the smaller of the two initial blocks
+        worklist = []
+        if len(blocks) == 2:
+            smaller = 0 if len(blocks[0]) <= len(blocks[1]) else 1
+            worklist = [(smaller, c) for c in xrange(width)]
+        waiting = set(worklist)
+
+        while worklist:
+            splitter = worklist.pop()
+            waiting.discard(splitter)
+            b, c = splitter
+
+            # group the states leading into the splitter block by the block they are in
+            touched = {}
+            predecessors = inverse[c]
+            for t in blocks[b]:
+                for s in predecessors[t]:
+                    touched.setdefault(block_of[s], []).append(s)
+
+            for y, members in touched.iteritems():
+                if len(members) == len(blocks[y]):
+                    continue
+                z = len(blocks)
+                new_block = set(members)
+                blocks[y] -= new_block
+                blocks.append(new_block)
+                for s in members:
+                    block_of[s] = z
+                for d in xrange(width):
+                    if (y, d) in waiting:
+                        split = (z, d)
+                    elif len(blocks[y]) <= len(blocks[z]):
+                        split = (y, d)
+                    else:
+                        split = (z, d)
+                    waiting.add(split)
+                    worklist.append(split)
+
+        # the dead state only exists for missing transitions, so leave its block out again
+        dead_block = block_of[compiled.dead_state]
+        if dead_block != -1 and dead_block != block_of[compiled.start]:
+            block_of = [-1 if b == dead_block else b for b in block_of]
+
+        return self.build_quotient(compiled, block_of)[0]
+
+    def quotient(self, pairs):
+        """
+        Merge pairs of equivalent states (such as the result of table_fill) with a union-find,
+        then build the reduced DFA in one pass over the delta table.
+        :param pairs: List of (p, q) state pairs known to be indistinguishable.
+        :return: The reduced DFA and a dict from each of its states to the original states it stands for.
+        """
+        compiled = self.get_compiled_dfa()
+        state_index = compiled.state_index
+        parent = range(compiled.dead_state + 1)
+
+        def find(s):
+            root = s
+            while parent[root] != root:
+                root = parent[root]
+            # compress the path behind us
+            while parent[s] != root:
+                parent[s], s = root, parent[s]
+            return root
+
+        for p, q in pairs:
+            p = find(state_index[p])
+            q = find(state_index[q])
+            if p != q:
+                parent[max(p, q)] = min(p, q)
+
+        class_of = [find(s) for s in xrange(compiled.dead_state + 1)]
+        class_of[compiled.dead_state] = -1
+        return self.build_quotient(compiled, class_of)
+
+    def build_quotient(self, compiled, class_of):
+        """
+        Build the DFA whose states are the given classes of states.
+        Class ids are renumbered by their first member, and each class is named after that member.
+        :param compiled: The CompiledDFA the state ids refer to.
+        :param class_of: Class id for every state id, -1 for states to leave out.
+        :return: The new DFA and a dict from each new state to the list of original states it stands for.
+        """
+        table = compiled.table
+        width = compiled.width
+
+        names = {}
+        members = []
+        representatives = []
+        for s in xrange(compiled.dead_state + 1):
+            c = class_of[s]
+            if c == -1:
+                continue
+            if c not in names:
+                names[c] = len(members)
+                members.append([])
+                representatives.append(s)
+            if s != compiled.dead_state:
+                members[names[c]].append(compiled.states[s])
+
+        dfa = DFA()
+        dfa.input_symbols = list(compiled.symbols)
+        dfa.states = [m[0] for m in members]
+        dfa.start_state = dfa.states[names[class_of[compiled.start]]]
+        dfa.delta_transition_table = {}
+        for i, s in enumerate(representatives):
+            row = {}
+            for j, symbol in enumerate(compiled.symbols):
+                end_class = class_of[table[s * width + j]]
+                row[str(symbol)] = [] if end_class == -1 else [dfa.states[names[end_class]]]
+            dfa.delta_transition_table[dfa.states[i]] = row
+            if compiled.accepting[s]:
+                dfa.accepting_states.append(dfa.states[i])
+
+        return dfa, dict((m[0], m) for m in members)
 
     # return the table of state inequivalences
     def table_fill(self):
@@ -52,41 +365,7 @@ class DFA(object):
         if verbose:
             print '\n==============================\n'
 
-        # create our list of marked pairs (distinguishable)
-        marked = []
-
-        # create a list of state pairs for our table-filling algorithm
-        pairs = []
-        for p in self.states:
-            for q in self.states:
-                if q != p:
-                    if (q, p) not in pairs and (p, q) not in pairs:
-                        # if the state goes to accepting state it must be marked
-                        if p in self.accepting_states or q in self.accepting_states:
-                            marked.append((p, q))
-                        else:
-                            pairs.append((p, q))
-
-        # create a list of indistinguishable nodes by listing all pairs and removing the marked ones as we find them
-        indistinguishable_pairs = pairs[:]
-
-        # algorithm requires that this be run twice
-        for i in range(2):
-            for p, q in pairs:
-                for transition in self.input_symbols:
-                    r = self.delta_transition_table[p][str(transition)]
-                    s = self.delta_transition_table[q][str(transition)]
-                    if r != [] and s != []:
-                        r = r[0]
-                        s = s[0]
-                        if s < r:
-                            _t = s
-                            s = r
-                            r = _t
-                        if (r, s) in marked:
-                            if (p, q) not in marked:
-                                marked.append((p, q))
-                                indistinguishable_pairs.remove((p, q))
+        indistinguishable_pairs = DistinguishabilityTable(self, witnesses=False).indistinguishable_pairs()
 
         if verbose:
             print "Indistinguishable Pairs:", indistinguishable_pairs
@@ -95,10 +374,537 @@ class DFA(object):
         return indistinguishable_pairs
 
 
+class CompiledDFA(object):
+    """
+    Integer indexed form of a DFA.
+
+    States and input symbols are interned to dense ints, delta is stored row-major in a flat array('i')
+    (one row per state, one column per symbol) and the accepting states are kept as a bitmap.
+    Missing transitions lead to an extra dead state (the last row), which loops on itself and never accepts.
+    """
+    def __init__(self, dfa):
+        self.states = list(dfa.states)
+        self.state_index = dict((s, i) for i, s in enumerate(self.states))
+        self.dead_state = len(self.states)
+
+        # tape symbols may be given as the symbol itself or as its character on the tape
+        self.symbols = list(dfa.input_symbols)
+        self.symbol_index = {}
+        for i, symbol in enumerate(self.symbols):
+            self.symbol_index[symbol] = i
+            self.symbol_index[str(symbol)] = i
+        self.width = len(self.symbols)
+
+        self.table = array('i', [self.dead_state]) * ((self.dead_state + 1) * self.width)
+        for i, s in enumerate(self.states):
+            transitions = dfa.delta_transition_table[s]
+            for j, symbol in enumerate(self.symbols):
+                end_states = transitions.get(str(symbol))
+                if end_states:
+                    self.table[i * self.width + j] = self.state_index[end_states[0]]
+
+        self.accepting = bytearray(self.dead_state + 1)
+        for s in dfa.accepting_states:
+            if s in self.state_index:
+                self.accepting[self.state_index[s]] = 1
+
+        self.start = self.state_index[dfa.start_state]
+        self.byte_classes = {}     # ignored bytes -> byte classes
+        self.lookup = None
+
+    def follow(self, current_state, transition):
+        # one step from a state id, symbols outside the alphabet lead to the dead state
+        column = self.symbol_index.get(transition)
+        if column is None:
+            return self.dead_state
+        return self.table[current_state * self.width + column]
+
+    def is_accepting(self, current_state):
+        return self.accepting[current_state] == 1
+
+    def run(self, transitions, current_state=None):
+        """
+        Follow the tape through the table.
+        :param transitions: Iterable of tape symbols.
+        :param current_state: State id to start from, the start state by default.
+        :return: The state id the tape ends in.
+        """
+        table = self.table
+        width = self.width
+        symbol_index = self.symbol_index
+        if current_state is None:
+            current_state = self.start
+        for transition in transitions:
+            current_state = table[current_state * width + symbol_index[transition]]
+        return current_state
+
+    def accepts(self, transitions):
+        return self.accepting[self.run(transitions)] == 1
+
+    def get_byte_classes(self, ignore=""):
+        """
+        Compress the 256 byte values into classes, bytes that move every state to the same state share a class.
+        Bytes that are not the character of a symbol only lead to the dead state, and ignored bytes loop on
+        every state.
+        :param ignore: Bytes to skip on the tape, they take precedence over symbol characters.
+        :return: (class_map, class_table, class_count) where class_map is a 256 entry bytearray from byte to class
+                 and class_table the row-major state x class transition array.
+        """
+        if ignore not in self.byte_classes:
+            dead_column = (self.dead_state,) * (self.dead_state + 1)
+            columns = [dead_column] * 256
+            for j, symbol in enumerate(self.symbols):
+                character = str(symbol)
+                if len(character) == 1:
+                    columns[ord(character)] = tuple(self.table[j::self.width])
+            for character in ignore:
+                columns[ord(character)] = tuple(range(self.dead_state + 1))
+
+            class_map = bytearray(256)
+            class_columns = []
+            classes = {}
+            for byte, column in enumerate(columns):
+                if column not in classes:
+                    classes[column] = len(class_columns)
+                    class_columns.append(column)
+                class_map[byte] = classes[column]
+
+            class_count = len(class_columns)
+            class_table = array('i', [self.dead_state]) * ((self.dead_state + 1) * class_count)
+            for k, column in enumerate(class_columns):
+                class_table[k::class_count] = array('i', column)
+
+            self.byte_classes[ignore] = (class_map, class_table, class_count)
+        return self.byte_classes[ignore]
+
+    def run_bytes(self, data, current_state=None, window=65536, ignore=""):
+        """
+        Follow a raw byte tape through the byte class table.
+        The data is iterated in place through buffer views of one window each, so none of it is copied:
+        each byte comes out as a one character string, looked up in a character to class dict.
+        :param ignore: Bytes to skip on the tape.
+        :return: The state id the tape ends in.
+        """
+        class_map, class_table, class_count = self.get_byte_classes(ignore)
+        class_of = dict((chr(byte), class_map[byte]) for byte in xrange(256))
+        if current_state is None:
+            current_state = self.start
+        for offset in xrange(0, len(data), window):
+            for character in buffer(data, offset, window):
+                current_state = class_table[current_state * class_count + class_of[character]]
+        return current_state
+
+    def reachable_states(self):
+        """
+        :return: The ids of the states reachable from the start state, in breadth first order.
+        """
+        seen = bytearray(self.dead_state + 1)
+        seen[self.start] = 1
+        order = [self.start]
+        for s in order:
+            for t in self.table[s * self.width:(s + 1) * self.width]:
+                if not seen[t]:
+                    seen[t] = 1
+                    order.append(t)
+        return order
+
+    def map_states(self, transitions):
+        """
+        Run the tape from every state (dead state included) at once.
+        Start states that land in the same state are merged as they go, and once only one
+        state is left the rest of the tape is run normally.
+        :return: array('i') mapping each start state id to the state id it ends in.
+        """
+        table = self.table
+        width = self.width
+        symbol_index = self.symbol_index
+
+        current_states = range(self.dead_state + 1)   # distinct states still being followed
+        position = range(self.dead_state + 1)         # index into current_states for each start state
+        transitions = iter(transitions)
+        steps = 0
+        for transition in transitions:
+            column = symbol_index[transition]
+            current_states = [table[s * width + column] for s in current_states]
+            steps += 1
+            if steps % 64 == 0:
+                merged = []
+                seen = {}
+                for s in current_states:
+                    if s not in seen:
+                        seen[s] = len(merged)
+                        merged.append(s)
+                position = [seen[current_states[p]] for p in position]
+                current_states = merged
+                if len(current_states) == 1:
+                    current_states[0] = self.run(transitions, current_states[0])
+                    break
+
+        return array('i', [current_states[p] for p in position])
+
+    def symbol_lookup(self):
+        """
+        Lookup arrays from tape symbols to columns for batch encoding, -1 for symbols outside the alphabet.
+        :return: (256 entry array indexed by the byte of a one character symbol,
+                  array indexed by the non-negative int symbols)
+        """
+        if self.lookup is None:
+            byte_lookup = numpy.empty(256, dtype=numpy.intp)
+            byte_lookup.fill(-1)
+            int_symbols = [symbol for symbol in self.symbol_index
+                           if isinstance(symbol, (int, long)) and not isinstance(symbol, bool) and symbol >= 0]
+            int_lookup = numpy.empty(max(int_symbols) + 1 if int_symbols else 0, dtype=numpy.intp)
+            int_lookup.fill(-1)
+            for symbol, column in self.symbol_index.iteritems():
+                if isinstance(symbol, str) and len(symbol) == 1:
+                    byte_lookup[ord(symbol)] = column
+                elif symbol in int_symbols:
+                    int_lookup[symbol] = column
+            self.lookup = (byte_lookup, int_lookup)
+        return self.lookup
+
+    def encode_bucket(self, tapes, length):
+        """
+        Encode tapes of the same length to columns in one pass, one row per tape.
+        Strings (str or unicode) are read as bytes and int symbols as one flat int array, both mapped
+        through the lookup arrays.
+        :return: Array of columns, or None if the tapes are of another kind or have symbols outside the alphabet.
+        """
+        byte_lookup, int_lookup = self.symbol_lookup()
+        rows = None
+        if all(isinstance(tape, basestring) for tape in tapes):
+            data = ''.join(tapes)
+            if isinstance(data, unicode):
+                # tapes loaded from json are unicode, characters past latin-1 are not one character symbols
+                try:
+                    data = data.encode('latin-1')
+                except UnicodeError:
+                    return None
+            rows = byte_lookup[numpy.frombuffer(data, dtype=numpy.uint8)]
+        elif isinstance(tapes[0][0], (int, long)):
+            # numpy picks an int dtype only if every symbol is an int
+            values = numpy.array(tapes)
+            if values.dtype.kind in 'iu' and values.shape == (len(tapes), length) and \
+                    values.min() >= 0 and values.max() < len(int_lookup):
+                rows = int_lookup[values]
+        if rows is None or (rows < 0).any():
+            return None
+        return rows.reshape(len(tapes), length)
+
+    def accepts_all(self, batch):
+        """
+        Bucket the tapes by length, encode each bucket as one array and advance every tape of a bucket
+        one step at a time by indexing the flat table with the current states and the column of symbols.
+        """
+        if numpy is None or self.width == 0:
+            return [self.accepts(transitions) for transitions in batch]
+
+        table = numpy.frombuffer(self.table, dtype=numpy.intc).astype(numpy.intp)
+        accepting = numpy.frombuffer(self.accepting, dtype=numpy.uint8).astype(bool)
+
+        buckets = {}
+        for i, transitions in enumerate(batch):
+            buckets.setdefault(len(transitions), []).append(i)
+
+        results = numpy.zeros(len(batch), dtype=bool)
+        for length, indices in buckets.iteritems():
+            if length == 0:
+                results[indices] = accepting[self.start]
+                continue
+            rows = self.encode_bucket([batch[i] for i in indices], length)
+            if rows is None:
+                # per symbol lookups cost the same as running the tapes, which also raises KeyError
+                # for symbols outside the alphabet
+                results[indices] = [self.accepts(batch[i]) for i in indices]
+                continue
+            # one row per step, one column per tape
+            steps = numpy.ascontiguousarray(rows.T)
+
+            current_states = numpy.empty(len(indices), dtype=numpy.intp)
+            current_states.fill(self.start)
+            for step in steps:
+                current_states *= self.width
+                current_states += step
+                current_states = table.take(current_states)
+            results[indices] = accepting[current_states]
+
+        return results
+
+
+class DistinguishabilityTable(object):
+    """
+    Table-filling algorithm run to a fixpoint over the compiled DFA.
+
+    Marks are kept in a packed triangular bitset with one bit per unordered pair of states.
+    Pairs split by acceptance are marked first, then every newly marked pair is propagated only to
+    its predecessor pairs through the reverse transition index. For each marked pair the symbol that
+    leads to an already marked pair is recorded, so distinguishing tapes can be read back.
+    The dead state takes part like any other state, so partial DFAs are handled.
+    """
+    def __init__(self, dfa, witnesses=True):
+        self.compiled = dfa.get_compiled_dfa()
+        compiled = self.compiled
+        table = compiled.table
+        width = compiled.width
+        size = compiled.dead_state + 1
+        pair_count = size * (size - 1) // 2
+
+        self.marks = bytearray((pair_count + 7) // 8)
+        self.witnesses = None
+        if witnesses:
+            # -1 for pairs split by acceptance, otherwise the symbol column leading to a marked pair
+            self.witnesses = array('b' if width < 127 else 'i', [-1]) * pair_count
+
+        inverse = [[[] for _ in xrange(size)] for _ in xrange(width)]
+        for s in xrange(size):
+            for c in xrange(width):
+                inverse[c][table[s * width + c]].append(s)
+
+        accepting = [s for s in xrange(size) if compiled.accepting[s]]
+        rejecting = [s for s in xrange(size) if not compiled.accepting[s]]
+        worklist = []
+        for p in accepting:
+            for q in rejecting:
+                self.mark(p, q)
+                worklist.append((p, q))
+
+        while worklist:
+            r, s = worklist.pop()
+            for c in xrange(width):
+                for p in inverse[c][r]:
+                    for q in inverse[c][s]:
+                        if p != q and not self.is_marked(p, q):
+                            self.mark(p, q, c)
+                            worklist.append((p, q))
+
+    @staticmethod
+    def pair_index(p, q):
+        # position of the unordered pair in the triangular table
+        if p < q:
+            p, q = q, p
+        return p * (p - 1) // 2 + q
+
+    def is_marked(self, p, q):
+        i = self.pair_index(p, q)
+        return self.marks[i >> 3] & (1 << (i & 7)) != 0
+
+    def mark(self, p, q, symbol=-1):
+        i = self.pair_index(p, q)
+        self.marks[i >> 3] |= 1 << (i & 7)
+        if self.witnesses is not None:
+            self.witnesses[i] = symbol
+
+    def is_distinguishable(self, p, q):
+        state_index = self.compiled.state_index
+        return p != q and self.is_marked(state_index[p], state_index[q])
+
+    def distinguishing_tape(self, p, q):
+        """
+        Read back a tape accepted from exactly one of the two states.
+        :return: List of symbols, or None if the states are indistinguishable.
+        """
+        if self.witnesses is None:
+            raise ValueError("distinguishing tapes need the table to be filled with witnesses=True")
+        if not self.is_distinguishable(p, q):
+            return None
+        compiled = self.compiled
+        p = compiled.state_index[p]
+        q = compiled.state_index[q]
+        tape = []
+        symbol = self.witnesses[self.pair_index(p, q)]
+        while symbol != -1:
+            tape.append(compiled.symbols[symbol])
+            p = compiled.table[p * compiled.width + symbol]
+            q = compiled.table[q * compiled.width + symbol]
+            symbol = self.witnesses[self.pair_index(p, q)]
+        return tape
+
+    def indistinguishable_pairs(self):
+        """
+        :return: List of the unmarked pairs (p, q), with p before q in the DFA's list of states.
+        """
+        states = self.compiled.states
+        pairs = []
+        for p in xrange(len(states)):
+            for q in xrange(p + 1, len(states)):
+                if not self.is_marked(p, q):
+                    pairs.append((states[p], states[q]))
+        return pairs
+
+
+# process pool workers for DFA.test_tape_parallel, the compiled table is handed over once per worker
+_chunk_worker_dfa = None
+
+
+def _init_chunk_worker(compiled):
+    global _chunk_worker_dfa
+    _chunk_worker_dfa = compiled
+
+
+def _map_chunk(transitions):
+    return _chunk_worker_dfa.map_states(transitions)
+
+
+class DFAMatcher(object):
+    """
+    Resumable matcher that runs a tape through a DFA one chunk at a time.
+
+    Only the current state is kept between chunks, so tapes read from a file, stdin or a pipe
+    are matched in constant memory without ever being loaded whole.
+    """
+    def __init__(self, dfa, ignore=" \t\r\n"):
+        self.compiled = dfa.get_compiled_dfa()
+        self.ignore = ignore    # tape characters skipped in string chunks (line breaks in tape files)
+        self.current_state = self.compiled.start
+        self.length = 0
+
+    @property
+    def state(self):
+        # the name of the current state, None once the tape has fallen into the dead state
+        if self.current_state == self.compiled.dead_state:
+            return None
+        return self.compiled.states[self.current_state]
+
+    def reset(self):
+        self.current_state = self.compiled.start
+        self.length = 0
+
+    def feed(self, chunk):
+        """
+        Continue the tape with the given chunk of symbols.
+        :param chunk: String of tape characters or list of symbols.
+        :return: The id of the state reached so far.
+        """
+        if self.ignore:
+            if isinstance(chunk, str):
+                chunk = chunk.translate(None, self.ignore)
+            elif isinstance(chunk, unicode):
+                chunk = chunk.translate(dict.fromkeys(ord(c) for c in self.ignore))
+        self.current_state = self.compiled.run(chunk, self.current_state)
+        self.length += len(chunk)
+        return self.current_state
+
+    def feed_stream(self, stream, chunk_size=65536):
+        """
+        Feed everything readable from a file-like object (open file, sys.stdin, pipe or socket.makefile()).
+        :return: Whether the tape read so far is accepted.
+        """
+        while True:
+            chunk = stream.read(chunk_size)
+            if not chunk:
+                break
+            self.feed(chunk)
+        return self.accepts()
+
+    def accepts(self):
+        return self.compiled.accepting[self.current_state] == 1
+
+
+# run a tape file through the dfa in chunks, filename "-" reads the tape from stdin
+def test_tape_file(dfa, filename, chunk_size=65536):
+    matcher = DFAMatcher(dfa)
+    if filename == "-":
+        return matcher.feed_stream(sys.stdin, chunk_size)
+    tape_file = open(filename)
+    try:
+        return matcher.feed_stream(tape_file, chunk_size)
+    finally:
+        tape_file.close()
+
+
+def words_to_dfa(words, sigma=None):
+    """
+    Build the minimal acyclic DFA accepting exactly the given words, with Daciuk's incremental algorithm.
+    Since the words come sorted, only the path of the previous word can still change: when the next word
+    leaves it, the abandoned suffix is minimized against a register of equivalent states (same finality,
+    same transitions), so memory stays proportional to the minimal automaton rather than to the list.
+    :param words: Iterable of words in sorted order, each a string of tape characters or a list of symbols.
+    :param sigma: The alphabet, by default the symbols found in the words.
+    :return: The minimal DFA, with states named "0", "1", ... in breadth first order from the start state.
+    """
+    transitions = []    # for each state id, dict from symbol to state id
+    final = bytearray()
+    free = []           # ids of states merged away, reused for new states
+
+    def new_state():
+        if free:
+            state_id = free.pop()
+            transitions[state_id] = {}
+            final[state_id] = 0
+            return state_id
+        transitions.append({})
+        final.append(0)
+        return len(transitions) - 1
+
+    register = {}
+    unchecked = []      # (parent, symbol, child) along the previous word, not yet registered
+
+    def minimize(down_to):
+        while len(unchecked) > down_to:
+            parent, symbol, child = unchecked.pop()
+            signature = (final[child], tuple(sorted(transitions[child].iteritems())))
+            if signature in register:
+                transitions[parent][symbol] = register[signature]
+                transitions[child] = None
+                free.append(child)
+            else:
+                register[signature] = child
+
+    root = new_state()
+    symbols = set()
+    previous = []
+    for word in words:
+        word = [str(symbol) for symbol in word]
+        if word < previous:
+            raise ValueError("Words must be sorted, %r comes after %r" % (''.join(word), ''.join(previous)))
+
+        common = 0
+        while common < min(len(word), len(previous)) and word[common] == previous[common]:
+            common += 1
+        minimize(common)
+
+        current_state = unchecked[-1][2] if unchecked else root
+        for symbol in word[common:]:
+            next_state = new_state()
+            transitions[current_state][symbol] = next_state
+            unchecked.append((current_state, symbol, next_state))
+            current_state = next_state
+            symbols.add(symbol)
+        final[current_state] = 1
+        previous = word
+    minimize(0)
+
+    if sigma is None:
+        sigma = [int(symbol) if symbol.isdigit() else symbol for symbol in sorted(symbols)]
+
+    order = [root]
+    names = {root: "0"}
+    for current_state in order:
+        for symbol, next_state in sorted(transitions[current_state].iteritems()):
+            if next_state not in names:
+                names[next_state] = str(len(order))
+                order.append(next_state)
+
+    dfa = DFA()
+    dfa.input_symbols = list(sigma)
+    dfa.states = [names[s] for s in order]
+    dfa.start_state = names[root]
+    dfa.accepting_states = [names[s] for s in order if final[s]]
+    dfa.delta_transition_table = {}
+    for current_state in order:
+        row = dict((str(symbol), []) for symbol in sigma)
+        for symbol, next_state in transitions[current_state].iteritems():
+            row[symbol] = [names[next_state]]
+        dfa.delta_transition_table[names[current_state]] = row
+    return dfa
+
+
 class NFA(DFA):
     def __init__(self):
         super(NFA, self).__init__()
         self.fringe = list()
+        self.determinization_stats = None
+        self.compiled_dfa = None
 
     def get_epsilon_states(self, state):
         try:
@@ -106,89 +912,802 @@ class NFA(DFA):
         except:
             return None
 
-    def test_tape(self, transitions):
-        current_states = [self.start_state]
-        for transition in transitions:
-            if verbose:
-                pass
-            for current_state in current_states:
-                if current_state not in self.fringe:
-                    self.fringe.append(current_state)
-                for epsilon_state in self.delta_transition_table[current_state]['e']:
-                    if epsilon_state not in self.fringe:
-                        self.fringe.append(epsilon_state)
+    def get_epsilon_closure(self, state):
+        # every state reachable from the state by epsilon transitions alone (the state included)
+        compiled = self.get_compiled()
+        return compiled.subset_states(compiled.closures[compiled.state_index[state]])
 
-            next_states = list()
-            for current_state in self.fringe:
-                destination_state = self.delta_transition_table[current_state][str(transition)][0]
-                if destination_state not in next_states:
-                    next_states.append(destination_state)
+    def test_tape(self, transitions):
+        """
+        Run the tape with the set of active states kept as one int bitmask.
+        Each step ORs together the precomputed successor masks of the active states only.
+        The fringe is left holding the states the tape ended in.
+        :return: True if any of the states reached at the end of the tape is accepting.
+        """
+        compiled = self.get_compiled()
+        if verbose:
+            current_states = compiled.start
+            for transition in transitions:
+                print compiled.subset_name(current_states), "-"+str(transition)+"->",
+                current_states = compiled.step(current_states, compiled.symbol_index[transition])
+            print compiled.subset_name(current_states)
+        else:
+            current_states = compiled.run(transitions)
 
-            current_states = next_states
+        self.fringe = compiled.subset_states(current_states)
+        return current_states & compiled.accepting != 0
 
-    def toDFA(self):
+    def compile(self):
         """
-        Do the NFA -> DFA algorithm, and return the current NFA as a DFA.
+        Intern the states and symbols into the successor bitmasks used by test_tape and toDFA.
+        :return: The CompiledNFA for this machine.
         """
-        new_states = list()
-        new_accepting_states = list()
-        delta = {}
-        for state in self.states:
-            compound_state = state
+        self.compiled = CompiledNFA(self)
+        self.compiled_dfa = None
+        return self.compiled
 
-            for destination_state in self.get_epsilon_states(state):
-                compound_state += destination_state
+    def get_compiled_dfa(self):
+        """
+        The methods inherited from DFA that need a deterministic table (test_tapes, test_bytes, equivalent,
+        minimize, table_fill, DFAMatcher...) run on the subset construction, built on first use.
+        Their states are the subset names of toDFA, such as "{A, B}".
+        :return: The CompiledDFA of toDFA().
+        """
+        if self.compiled_dfa is None:
+            self.compiled_dfa = self.toDFA().compile()
+        return self.compiled_dfa
 
-            # if we have not seen this compound state before, we should add it to our new DFA
-            if compound_state not in new_states:
-                # first, make sure the compound node is sorted so AB == BA, etc.
-                compound_state = ''.join(sorted(compound_state))
+    def is_universal(self):
+        """
+        Check whether the NFA accepts every tape over its alphabet, with the antichain algorithm:
+        subsets of states are explored forward, keeping only the subset-minimal ones, since a
+        subset rejects everything a larger subset rejects.
+        :return: (universal, tape, stats) where tape is a rejected tape (None if universal)
+                 and stats the macrostate counts of the search.
+        """
+        compiled = self.get_compiled()
 
-                # add the state to the list of new states
-                new_states.append(compound_state)
+        def post(key, subset):
+            return [(symbol, key, compiled.step(subset, column)) for column, symbol in enumerate(compiled.symbols)]
 
-                # check all our accepting states, if this compound state contains a previous accepting state, add it.
-                for accepting_state in self.accepting_states:
-                    if accepting_state in compound_state:
-                        new_accepting_states.append(compound_state)
+        def is_rejecting(key, subset):
+            return subset & compiled.accepting == 0
 
-        for state in new_states:
-            for transition in self.input_symbols:
-                # get the destination states by following the transition and then epsilon
-                # only use the first state in the compound state (state[:1]), since the compound state
-                # has a common end state for all the states which compose it.
-                end_state = self.get_end_state(state[:1], transition)
-                print state[:1], transition, end_state
+        tape, stats = antichain_search([(0, compiled.start)], post, is_rejecting)
+        return tape is None, tape, stats
 
-                if end_state is None:
-                    continue
+    def is_subset(self, other):
+        """
+        Check whether every tape accepted by the NFA is accepted by another NFA, with the antichain algorithm
+        over macrostates (state of this NFA, subset of the other's states). Only macrostates whose subset is
+        minimal among those with the same state are kept.
+        :return: (included, tape, stats) where tape is accepted here but not by the other (None if included)
+                 and stats the macrostate counts of the search.
+        """
+        left = self.get_compiled()
+        right = other.get_compiled()
+        symbols = left.symbols
+
+        def post(key, subset):
+            macrostates = []
+            for column, symbol in enumerate(symbols):
+                end_subset = right.follow(subset, symbol)
+                for end_state in bit_indices(left.successors[column][key]):
+                    macrostates.append((symbol, end_state, end_subset))
+            return macrostates
+
+        def is_counterexample(key, subset):
+            return left.accepting >> key & 1 and subset & right.accepting == 0
+
+        starts = [(s, right.start) for s in bit_indices(left.start)]
+        tape, stats = antichain_search(starts, post, is_counterexample)
+        return tape is None, tape, stats
+
+    def remove_epsilons(self):
+        """
+        Build an equivalent NFA without epsilon transitions.
+        Each state takes over the symbol transitions of every state in its epsilon closure, and is
+        accepting if its closure holds an accepting state.
+        :return: A new NFA whose 'e' columns are all empty.
+        """
+        compiled = self.get_compiled()
 
-                destination_states = self.get_epsilon_states(end_state)
+        delta = {}
+        for i, s in enumerate(self.states):
+            closure_states = [self.states[j] for j in bit_indices(compiled.closures[i])]
+            delta[s] = {'e': []}
+            for transition in self.input_symbols:
+                end_states = []
+                for closure_state in closure_states:
+                    for end_state in self.delta_transition_table[closure_state].get(str(transition), []):
+                        if end_state not in end_states:
+                            end_states.append(end_state)
+                delta[s][str(transition)] = end_states
 
-                # this new compound state is made up of the destination states following the transition symbol + epsilon
-                compound_state = ""
-                for destination_state in destination_states:
-                    compound_state += destination_state
-                compound_state = ''.join(sorted(compound_state))
+        nfa = NFA()
+        nfa.delta_transition_table = delta
+        nfa.states = list(self.states)
+        nfa.accepting_states = [s for i, s in enumerate(self.states) if compiled.closures[i] & compiled.accepting]
+        nfa.input_symbols = self.input_symbols
+        nfa.start_state = self.start_state
 
-                # create our new delta table, with transitions for this state.
-                delta[state] = {}
-                for _transition in self.input_symbols:
-                    delta[state][_transition] = {}
+        return nfa
 
-                # finally, add the compound state as the result of the transition, (epsilon removed)
-                delta[state][transition] = compound_state
+    def toDFA(self, max_states=None, timeout=None, max_bytes=None):
+        """
+        Do the NFA -> DFA algorithm, and return the current NFA as a DFA.
+        Subsets of NFA states are bitmasks, built from a worklist so only the reachable subsets
+        are visited. DFA states are named after their subset, e.g. "{A, B}", and transitions to
+        the empty subset are left out.
+
+        The construction can be limited, raising DeterminizationAborted (with a partial progress report)
+        as soon as a limit is hit, so callers can refuse the input or fall back to NFA simulation or LazyDFA.
+        Statistics of the last run, including peak memory, are kept in self.determinization_stats.
+        :param max_states: Maximum number of DFA states.
+        :param timeout: Wall-clock seconds allowed for the construction.
+        :param max_bytes: Approximate bytes allowed for the subsets, their rows and the final table.
+        """
+        compiled = self.compile()
+        started = time.time()
+        deadline = started + timeout if timeout is not None else None
+        # approximate cost of one DFA state in the final dict table
+        row_bytes = 300 + 150 * compiled.width
+
+        stats = {"states": 1, "processed": 0, "bytes": 0, "peak_bytes": 0, "peak_rss": 0, "elapsed": 0.0,
+                 "aborted": None}
+        self.determinization_stats = stats
+
+        def check(reason):
+            stats["elapsed"] = time.time() - started
+            stats["peak_bytes"] = max(stats["peak_bytes"], stats["bytes"])
+            stats["peak_rss"] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+            if reason is not None:
+                stats["aborted"] = reason
+                raise DeterminizationAborted("Determinization aborted: %s after %d states (%d processed)"
+                                             % (reason, stats["states"], stats["processed"]), stats)
+
+        subset_ids = {compiled.start: 0}
+        subsets = [compiled.start]
+        stats["bytes"] = sys.getsizeof(compiled.start) + row_bytes
+        rows = []
+        for subset in subsets:
+            row = []
+            for column in xrange(compiled.width):
+                end_subset = compiled.step(subset, column)
+                if end_subset and end_subset not in subset_ids:
+                    subset_ids[end_subset] = len(subsets)
+                    subsets.append(end_subset)
+                    stats["states"] += 1
+                    stats["bytes"] += sys.getsizeof(end_subset) + row_bytes
+                    if max_states is not None and stats["states"] > max_states:
+                        check("more than %d states" % max_states)
+                    if max_bytes is not None and stats["bytes"] > max_bytes:
+                        check("more than %d bytes" % max_bytes)
+                row.append(subset_ids[end_subset] if end_subset else -1)
+            rows.append(row)
+            stats["processed"] += 1
+            if deadline is not None and time.time() > deadline:
+                check("timeout of %s seconds" % timeout)
+
+        new_states = [compiled.subset_name(subset) for subset in subsets]
+        delta = {}
+        for i, row in enumerate(rows):
+            delta[new_states[i]] = {}
+            for column, transition in enumerate(compiled.symbols):
+                delta[new_states[i]][str(transition)] = [new_states[row[column]]] if row[column] != -1 else []
 
         dfa = DFA()
         dfa.delta_transition_table = delta
         dfa.states = new_states
-        dfa.accepting_states = new_accepting_states
+        dfa.accepting_states = [new_states[i] for i, subset in enumerate(subsets) if subset & compiled.accepting]
         dfa.input_symbols = self.input_symbols
-        dfa.start_state = self.start_state
+        dfa.start_state = new_states[0]
+
+        check(None)
+        return dfa
+
+
+class DeterminizationAborted(Exception):
+    """
+    Raised by NFA.toDFA when a limit is hit, report holds the progress made (see NFA.determinization_stats).
+    """
+    def __init__(self, message, report):
+        super(DeterminizationAborted, self).__init__(message)
+        self.report = report
 
+
+# returns the positions of the set bits of a mask, lowest first
+def bit_indices(mask):
+    indices = []
+    while mask:
+        low = mask & -mask
+        indices.append(low.bit_length() - 1)
+        mask ^= low
+    return indices
+
+
+def antichain_search(starts, post, is_bad):
+    """
+    Breadth first search over macrostates (key, subset) for a bad one, keeping only an antichain:
+    a macrostate is dropped when another with the same key has a subset of its states, and
+    macrostates made redundant by a new, smaller one are taken off the worklist.
+    :param starts: The initial (key, subset) macrostates.
+    :param post: Function of (key, subset) returning the list of (symbol, key, subset) successors.
+    :param is_bad: Function of (key, subset), True for the macrostates the search looks for.
+    :return: (tape, stats) with the tape leading to a bad macrostate (None if there is none),
+             and counts of the macrostates built, subsumed and kept at most in the antichain.
+    """
+    nodes = []      # (key, subset, parent node, symbol)
+    alive = bytearray()
+    antichain = {}  # key -> ids of the nodes currently kept
+    stats = {"macrostates": 0, "subsumed": 0, "antichain": 0, "max_antichain": 0}
+
+    def add(key, subset, parent, symbol):
+        kept = antichain.get(key, [])
+        for i in kept:
+            if nodes[i][1] & ~subset == 0:
+                stats["subsumed"] += 1
+                return None
+        survivors = []
+        for i in kept:
+            if subset & ~nodes[i][1] == 0:
+                alive[i] = 0
+                stats["subsumed"] += 1
+                stats["antichain"] -= 1
+            else:
+                survivors.append(i)
+        survivors.append(len(nodes))
+        antichain[key] = survivors
+        nodes.append((key, subset, parent, symbol))
+        alive.append(1)
+        stats["macrostates"] += 1
+        stats["antichain"] += 1
+        stats["max_antichain"] = max(stats["max_antichain"], stats["antichain"])
+        return len(nodes) - 1
+
+    def tape_to(node):
+        tape = []
+        while nodes[node][2] is not None:
+            tape.append(nodes[node][3])
+            node = nodes[node][2]
+        tape.reverse()
+        return tape
+
+    queue = []
+    for key, subset in starts:
+        node = add(key, subset, None, None)
+        if node is not None:
+            if is_bad(key, subset):
+                return tape_to(node), stats
+            queue.append(node)
+
+    for node in queue:
+        if not alive[node]:
+            continue
+        key, subset = nodes[node][:2]
+        for symbol, end_key, end_subset in post(key, subset):
+            end_node = add(end_key, end_subset, node, symbol)
+            if end_node is None:
+                continue
+            if is_bad(end_key, end_subset):
+                return tape_to(end_node), stats
+            queue.append(end_node)
+
+    return None, stats
+
+
+def epsilon_closures(states, delta):
+    """
+    Compute the full epsilon closure of every state as a bitmask (bit i for states[i]).
+    The strongly connected components of the epsilon graph are found with Tarjan's algorithm. All states
+    of a component share one closure, and since components are finished in reverse topological order,
+    that closure is the component's states OR'd with the already finished closures it has edges to.
+    :return: List of closure masks, in the order of states.
+    """
+    index = dict((s, i) for i, s in enumerate(states))
+    successors = [[index[t] for t in delta[s].get('e', [])] for s in states]
+    size = len(states)
+
+    order = [-1] * size
+    low = [0] * size
+    on_stack = bytearray(size)
+    stack = []
+    closures = [0] * size
+    counter = 0
+    for root in xrange(size):
+        if order[root] != -1:
+            continue
+        order[root] = low[root] = counter
+        counter += 1
+        stack.append(root)
+        on_stack[root] = 1
+        work = [(root, 0)]    # explicit call stack of (state, next edge) to avoid deep recursion
+        while work:
+            v, i = work[-1]
+            if i < len(successors[v]):
+                work[-1] = (v, i + 1)
+                w = successors[v][i]
+                if order[w] == -1:
+                    order[w] = low[w] = counter
+                    counter += 1
+                    stack.append(w)
+                    on_stack[w] = 1
+                    work.append((w, 0))
+                elif on_stack[w]:
+                    low[v] = min(low[v], order[w])
+                continue
+
+            work.pop()
+            if work:
+                u = work[-1][0]
+                low[u] = min(low[u], low[v])
+            if low[v] == order[v]:
+                members = []
+                closure = 0
+                while True:
+                    w = stack.pop()
+                    on_stack[w] = 0
+                    members.append(w)
+                    closure |= 1 << w
+                    if w == v:
+                        break
+                for w in members:
+                    for t in successors[w]:
+                        closure |= closures[t]
+                for w in members:
+                    closures[w] = closure
+
+    return closures
+
+
+class CompiledNFA(object):
+    """
+    Bitmask form of an NFA.
+
+    States and input symbols are interned to dense ints and a set of states is an int with one bit
+    per state. For every symbol and state the successor mask already includes the epsilon closure
+    of the end states, so a step never has to follow epsilon transitions.
+    """
+    def __init__(self, nfa):
+        self.states = list(nfa.states)
+        self.state_index = dict((s, i) for i, s in enumerate(self.states))
+
+        self.symbols = list(nfa.input_symbols)
+        self.symbol_index = {}
+        for i, symbol in enumerate(self.symbols):
+            self.symbol_index[symbol] = i
+            self.symbol_index[str(symbol)] = i
+        self.width = len(self.symbols)
+
+        delta = nfa.delta_transition_table
+        self.closures = epsilon_closures(self.states, delta)
+
+        # successors[column][state] is the closure of the states reached on that symbol
+        self.successors = []
+        for symbol in self.symbols:
+            masks = []
+            for s in self.states:
+                mask = 0
+                for t in delta[s].get(str(symbol), []):
+                    mask |= self.closures[self.state_index[t]]
+                masks.append(mask)
+            self.successors.append(masks)
+
+        self.accepting = 0
+        for s in nfa.accepting_states:
+            if s in self.state_index:
+                self.accepting |= 1 << self.state_index[s]
+
+        self.start = self.closures[self.state_index[nfa.start_state]]
+
+    def step(self, subset, column):
+        # union of the successor masks of every state in the subset
+        successors = self.successors[column]
+        end_subset = 0
+        while subset:
+            low = subset & -subset
+            end_subset |= successors[low.bit_length() - 1]
+            subset ^= low
+        return end_subset
+
+    def run(self, transitions, subset=None):
+        """
+        Follow the tape from the start closure (or the given subset).
+        :return: The subset of states the tape ends in.
+        """
+        successors = self.successors
+        symbol_index = self.symbol_index
+        if subset is None:
+            subset = self.start
+        for transition in transitions:
+            column_successors = successors[symbol_index[transition]]
+            remaining = subset
+            subset = 0
+            while remaining:
+                low = remaining & -remaining
+                subset |= column_successors[low.bit_length() - 1]
+                remaining ^= low
+        return subset
+
+    def follow(self, subset, transition):
+        # one step from a subset, symbols outside the alphabet lead to the empty subset
+        column = self.symbol_index.get(transition)
+        if column is None:
+            return 0
+        return self.step(subset, column)
+
+    def is_accepting(self, subset):
+        return subset & self.accepting != 0
+
+    def subset_states(self, subset):
+        return [self.states[i] for i in bit_indices(subset)]
+
+    def subset_name(self, subset):
+        return "{" + ", ".join(self.subset_states(subset)) + "}"
+
+
+class ProductDFA(ProductOperators):
+    """
+    Lazy product of machines, accepting when the combination of their results is true.
+
+    Operands are DFAs, NFAs (stepped as subsets) or other products. Only the tuples of operand
+    states reached by a tape are built, each interned to an id with its transitions cached as
+    they are followed, so tapes run without materializing the full |Q1| x |Q2| table.
+    The alphabet is the union of the operands' alphabets.
+    """
+    def __init__(self, operands, combine):
+        self.operands = [o.get_compiled() for o in operands]
+        self.combine = combine
+
+        self.symbols = []
+        self.symbol_index = {}
+        for operand in self.operands:
+            for symbol in operand.symbols:
+                if str(symbol) not in self.symbol_index:
+                    self.symbol_index[symbol] = len(self.symbols)
+                    self.symbol_index[str(symbol)] = len(self.symbols)
+                    self.symbols.append(symbol)
+        self.width = len(self.symbols)
+
+        self.tuple_ids = {}
+        self.tuples = []
+        self.transitions = []   # row-major state x symbol, -1 until the transition is followed
+        self.accepting = bytearray()
+        self.start = self.get_state(tuple(operand.start for operand in self.operands))
+
+    def get_compiled(self):
+        # products are already in their runnable form
+        return self
+
+    def get_state(self, states):
+        """
+        :return: The id of the tuple of operand states, interning it if needed.
+        """
+        try:
+            return self.tuple_ids[states]
+        except KeyError:
+            pass
+        state_id = len(self.tuples)
+        self.tuple_ids[states] = state_id
+        self.tuples.append(states)
+        self.transitions.extend([-1] * self.width)
+        accepted = [operand.is_accepting(s) for operand, s in zip(self.operands, states)]
+        self.accepting.append(1 if self.combine(accepted) else 0)
+        return state_id
+
+    def follow(self, current_state, transition):
+        column = self.symbol_index.get(transition)
+        if column is not None:
+            next_state = self.transitions[current_state * self.width + column]
+            if next_state != -1:
+                return next_state
+        states = self.tuples[current_state]
+        next_state = self.get_state(tuple(operand.follow(s, transition) for operand, s in zip(self.operands, states)))
+        if column is not None:
+            self.transitions[current_state * self.width + column] = next_state
+        return next_state
+
+    def is_accepting(self, current_state):
+        return self.accepting[current_state] == 1
+
+    def test_tape(self, transitions):
+        current_state = self.start
+        for transition in transitions:
+            current_state = self.follow(current_state, transition)
+        return self.accepting[current_state] == 1
+
+    def find_accepted(self):
+        """
+        Search the product breadth first from the start, stopping at the first accepting state.
+        (a & b).find_accepted() tells whether two machines overlap without building their product.
+        :return: The shortest accepted tape as a list of symbols, or None if the language is empty.
+        """
+        if self.accepting[self.start]:
+            return []
+        came_from = {self.start: None}
+        queue = [self.start]
+        for current_state in queue:
+            for symbol in self.symbols:
+                next_state = self.follow(current_state, symbol)
+                if next_state in came_from:
+                    continue
+                came_from[next_state] = (current_state, symbol)
+                if self.accepting[next_state]:
+                    tape = []
+                    while came_from[next_state] is not None:
+                        next_state, symbol = came_from[next_state]
+                        tape.append(symbol)
+                    tape.reverse()
+                    return tape
+                queue.append(next_state)
+        return None
+
+    def is_empty(self):
+        return self.find_accepted() is None
+
+    def to_dfa(self):
+        """
+        Materialize the reachable part of the product as a DFA with states named q0, q1, ...
+        """
+        queue = [self.start]
+        seen = set(queue)
+        for current_state in queue:
+            for symbol in self.symbols:
+                next_state = self.follow(current_state, symbol)
+                if next_state not in seen:
+                    seen.add(next_state)
+                    queue.append(next_state)
+
+        names = dict((s, "q" + str(i)) for i, s in enumerate(queue))
+        dfa = DFA()
+        dfa.input_symbols = list(self.symbols)
+        dfa.states = [names[s] for s in queue]
+        dfa.start_state = names[self.start]
+        dfa.accepting_states = [names[s] for s in queue if self.accepting[s]]
+        dfa.delta_transition_table = {}
+        for s in queue:
+            dfa.delta_transition_table[names[s]] = \
+                dict((str(symbol), [names[self.follow(s, symbol)]]) for symbol in self.symbols)
         return dfa
 
 
+class LazyDFA(object):
+    """
+    On-the-fly determinization of an NFA, in the style of RE2's DFA.
+
+    DFA states (subsets of NFA states) are only built the first time a tape reaches them, and
+    their transitions are cached as they are followed. When the cache would outgrow its memory
+    budget it is flushed and rebuilt from the current state, so memory stays bounded no matter how
+    large the full DFA would be. Cache hits, misses and flushes are counted for sizing the budget.
+    """
+    def __init__(self, nfa, max_bytes=1 << 22):
+        self.compiled = nfa.get_compiled()
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.flushes = 0
+        self.clear()
+
+    def clear(self):
+        # drop every cached state and transition
+        self.subset_ids = {}
+        self.subsets = []
+        self.transitions = []   # row-major state x symbol, -1 until the transition is followed
+        self.accepting = bytearray()
+        self.cache_bytes = 0
+
+    def state_cost(self, subset):
+        # approximate bytes held by one cached state: the mask, its dict entry and its row of transitions
+        return sys.getsizeof(subset) + 100 + 8 * self.compiled.width
+
+    def get_state(self, subset):
+        """
+        :return: The id of the cached state for the subset, building it if needed.
+        """
+        try:
+            return self.subset_ids[subset]
+        except KeyError:
+            pass
+        state_id = len(self.subsets)
+        self.subset_ids[subset] = state_id
+        self.subsets.append(subset)
+        self.transitions.extend([-1] * self.compiled.width)
+        self.accepting.append(1 if subset & self.compiled.accepting else 0)
+        self.cache_bytes += self.state_cost(subset)
+        return state_id
+
+    def run(self, transitions):
+        """
+        Follow the tape through the cached states, building the missing ones.
+        :return: The id of the cached state the tape ends in.
+        """
+        compiled = self.compiled
+        width = compiled.width
+        symbol_index = compiled.symbol_index
+
+        current_state = self.get_state(compiled.start)
+        for transition in transitions:
+            column = symbol_index[transition]
+            next_state = self.transitions[current_state * width + column]
+            if next_state != -1:
+                self.hits += 1
+                current_state = next_state
+                continue
+
+            self.misses += 1
+            subset = self.subsets[current_state]
+            end_subset = compiled.step(subset, column)
+            if end_subset not in self.subset_ids and \
+                    self.cache_bytes + self.state_cost(end_subset) > self.max_bytes:
+                self.flushes += 1
+                self.clear()
+                current_state = self.get_state(subset)
+            next_state = self.get_state(end_subset)
+            self.transitions[current_state * width + column] = next_state
+            current_state = next_state
+
+        return current_state
+
+    def test_tape(self, transitions):
+        # run first, the cache (and its accepting bitmap) may be flushed along the way
+        final_state = self.run(transitions)
+        return self.accepting[final_state] == 1
+
+    def get_stats(self):
+        return {"hits": self.hits, "misses": self.misses, "flushes": self.flushes,
+                "states": len(self.subsets), "bytes": self.cache_bytes}
+
+
+class ThompsonBuilder(object):
+    """
+    Recursive descent parser turning a regular expression into an epsilon-NFA by Thompson's construction.
+
+    Patterns are made of the symbols of sigma (one character each), '.' for any symbol, grouping
+    with ( ), alternation with | and the postfix operators *, + and ?. A backslash escapes the next
+    character, and an empty alternative such as (0|) matches the empty tape. Every operator adds at
+    most two states, so the NFA is linear in the size of the pattern.
+    """
+    operators = "|*+?()."
+
+    def __init__(self, pattern, sigma):
+        self.pattern = pattern
+        self.position = 0
+        self.sigma = [str(symbol) for symbol in sigma]
+        self.edges = []     # for each state, the list of (symbol or 'e', end state)
+
+    def new_state(self):
+        self.edges.append([])
+        return len(self.edges) - 1
+
+    def error(self, message):
+        return ValueError("%s at position %d of regex %r" % (message, self.position, self.pattern))
+
+    def peek(self):
+        if self.position < len(self.pattern):
+            return self.pattern[self.position]
+        return None
+
+    def parse_alternation(self):
+        start, accept = self.parse_concatenation()
+        while self.peek() == "|":
+            self.position += 1
+            other_start, other_accept = self.parse_concatenation()
+            new_start = self.new_state()
+            new_accept = self.new_state()
+            self.edges[new_start] += [('e', start), ('e', other_start)]
+            self.edges[accept].append(('e', new_accept))
+            self.edges[other_accept].append(('e', new_accept))
+            start, accept = new_start, new_accept
+        return start, accept
+
+    def parse_concatenation(self):
+        start = accept = self.new_state()
+        while self.peek() is not None and self.peek() not in "|)":
+            atom_start, atom_accept = self.parse_repetition()
+            self.edges[accept].append(('e', atom_start))
+            accept = atom_accept
+        return start, accept
+
+    def parse_repetition(self):
+        start, accept = self.parse_atom()
+        while self.peek() is not None and self.peek() in "*+?":
+            operator = self.peek()
+            self.position += 1
+            new_start = self.new_state()
+            new_accept = self.new_state()
+            self.edges[new_start].append(('e', start))
+            self.edges[accept].append(('e', new_accept))
+            if operator in "*?":
+                self.edges[new_start].append(('e', new_accept))
+            if operator in "*+":
+                self.edges[accept].append(('e', start))
+            start, accept = new_start, new_accept
+        return start, accept
+
+    def parse_atom(self):
+        c = self.peek()
+        if c is None:
+            raise self.error("Unexpected end")
+        self.position += 1
+        if c == "(":
+            start, accept = self.parse_alternation()
+            if self.peek() != ")":
+                raise self.error("Missing )")
+            self.position += 1
+            return start, accept
+
+        if c == ".":
+            symbols = self.sigma
+        elif c == "\\":
+            c = self.peek()
+            if c is None:
+                raise self.error("Dangling escape")
+            self.position += 1
+            symbols = [c]
+        elif c in self.operators:
+            raise self.error("Unexpected %r" % c)
+        else:
+            symbols = [c]
+
+        for symbol in symbols:
+            if symbol not in self.sigma:
+                raise self.error("Symbol %r is not in sigma" % symbol)
+        start = self.new_state()
+        accept = self.new_state()
+        for symbol in symbols:
+            self.edges[start].append((symbol, accept))
+        return start, accept
+
+    def build(self):
+        """
+        :return: The NFA for the whole pattern, with states named q0, q1, ...
+        """
+        start, accept = self.parse_alternation()
+        if self.peek() is not None:
+            raise self.error("Unexpected %r" % self.peek())
+
+        nfa = NFA()
+        nfa.states = ["q" + str(i) for i in xrange(len(self.edges))]
+        nfa.input_symbols = [int(symbol) if symbol.isdigit() else symbol for symbol in self.sigma]
+        nfa.start_state = nfa.states[start]
+        nfa.accepting_states = [nfa.states[accept]]
+        nfa.delta_transition_table = {}
+        for i, edges in enumerate(self.edges):
+            row = {'e': []}
+            for symbol in self.sigma:
+                row[symbol] = []
+            for symbol, end_state in edges:
+                row[symbol].append(nfa.states[end_state])
+            nfa.delta_transition_table[nfa.states[i]] = row
+        return nfa
+
+
+# compiled patterns, most recently used last
+_regex_cache = OrderedDict()
+
+
+def compile_regex(pattern, sigma, determinize=False):
+    """
+    Compile a regular expression over sigma into a machine, see ThompsonBuilder for the syntax.
+    The last regex_cache_size patterns are kept in an LRU cache, so treat the result as read-only.
+    :param pattern: The regular expression.
+    :param sigma: The alphabet, e.g. the list parsed from a machine's "sigma".
+    :param determinize: If True, return the minimal DFA instead of the Thompson NFA.
+    :return: The NFA (or DFA) accepting the pattern.
+    """
+    key = (pattern, tuple(str(symbol) for symbol in sigma), determinize)
+    try:
+        machine = _regex_cache.pop(key)
+    except KeyError:
+        machine = ThompsonBuilder(pattern, sigma).build()
+        if determinize:
+            machine = machine.toDFA().minimize()
+    _regex_cache[key] = machine
+    while len(_regex_cache) > regex_cache_size:
+        _regex_cache.popitem(last=False)
+    return machine
+
+
 class Alphabet(object):
     def __init__(self):
         self.set = list()
@@ -283,10 +1802,96 @@ class Stack(object):
         self.stack_array[-1] = symbol
 
 
-class PushDownAutomata(NFA):
+class StackGraph(object):
+    """
+    Table of hash-consed stack nodes shared by many stacks.
+
+    A node is (symbol, parent node) with a dense id, interned so that equal stacks are the same node
+    and any number of stacks share their common suffixes. The empty stack is -1. Each node also keeps
+    its depth, so the length of a stack is O(1) to read.
+    """
     def __init__(self):
+        self.node_ids = {}
+        self.symbols = []
+        self.parents = []
+        self.depths = []
+
+    def push(self, node, symbol):
+        key = (symbol, node)
+        try:
+            return self.node_ids[key]
+        except KeyError:
+            pass
+        self.node_ids[key] = len(self.symbols)
+        self.symbols.append(symbol)
+        self.parents.append(node)
+        self.depths.append(1 if node == -1 else self.depths[node] + 1)
+        return len(self.symbols) - 1
+
+    def items(self, node):
+        # the symbols of the stack, bottom first
+        items = []
+        while node != -1:
+            items.append(self.symbols[node])
+            node = self.parents[node]
+        items.reverse()
+        return items
+
+
+class SharedStack(object):
+    """
+    Persistent stack on a StackGraph with the interface of Stack, usable as the stack of a PushDownAutomata.
+    Push, pop, replace and fork are O(1), and forked stacks share all of their nodes.
+    """
+    def __init__(self, graph=None, node=None):
+        self.graph = graph if graph is not None else StackGraph()
+        if node is None:
+            node = self.graph.push(-1, "Z")
+        self.node = node
+
+    @property
+    def stack_array(self):
+        return self.graph.items(self.node)
+
+    def __len__(self):
+        return 0 if self.node == -1 else self.graph.depths[self.node]
+
+    def fork(self):
+        return SharedStack(self.graph, self.node)
+
+    def peek(self):
+        return self.get_current()
+
+    def get_current(self):
+        if self.node == -1:
+            return "Z"      # marker for end of stack when it is empty
+        return self.graph.symbols[self.node]
+
+    def push(self, symbol):
+        self.node = self.graph.push(self.node, symbol)
+
+    def push_all(self, symbol_string):
+        # push the symbols to the top of the stack (in order given)
+        for c in symbol_string:
+            self.push(c)
+
+    def pop(self):
+        if self.node == -1:
+            raise IndexError("pop from empty stack")
+        top = self.graph.symbols[self.node]
+        self.node = self.graph.parents[self.node]
+        return top
+
+    def replace(self, symbol):
+        if self.node == -1:
+            raise IndexError("replace on empty stack")
+        self.node = self.graph.push(self.graph.parents[self.node], symbol)
+
+
+class PushDownAutomata(NFA):
+    def __init__(self, stack_class=Stack):
         super(PushDownAutomata, self).__init__()
-        self.stack = Stack()
+        self.stack = stack_class()
         self.test_cases = list()
         self.stack_symbols = list()     # denoted by symbol T, the set of stack symbols
         self.stack_start_symbol = None  # Z_0 is the stack symbol at the start
@@ -387,6 +1992,907 @@ class PushDownAutomata(NFA):
                 self.delta_transition_table.append({})
 
 
+class ExplorationAborted(Exception):
+    """
+    Raised by NondeterministicPDA.test when a budget runs out before the tape is decided.
+    """
+    def __init__(self, message, report):
+        super(ExplorationAborted, self).__init__(message)
+        self.report = report
+
+
+class NondeterministicPDA(object):
+    """
+    Push-down automaton with nondeterministic and epsilon moves, decided by tabulation.
+
+    Rather than following whole stacks, the search works on pops: a call (state, symbol, position) asks
+    in which (state, position) the machine can be once the symbol on top of the stack at that point has
+    been popped, whatever lies below it. A move replacing the top by Y1..Yk then finishes once Y1, ..., Yk
+    have been popped in turn, and each answer found for a call is a summary, passed on to every move
+    waiting for that call. Calls are the nodes of a graph-structured stack: all the stacks with the same top
+    at the same position share one node, so each pop is worked out once however many branches reach it.
+    Calls, moves in progress and summaries are each kept once, so the search takes polynomial time even for
+    ambiguous, left recursive or nullable grammars. Moves whose remaining symbols must consume more input
+    than is left (from min_yield) are pruned.
+    """
+    def __init__(self):
+        self.states = list()
+        self.start_state = None
+        self.accepting_states = list()
+        self.stack_start_symbol = "Z"
+        self.accept_by_empty_stack = False
+        self.transitions = {}   # (state, input symbol or 'e', stack top) -> list of (end state, symbols to push)
+        self.min_yield = {}     # stack symbol -> least number of input symbols it consumes (0 if unknown)
+        self.stats = None
+
+    def add_transition(self, state, input_symbol, stack_top, end_state, push):
+        """
+        Add a move: in state, reading input_symbol ('e' for none) with stack_top on the stack,
+        go to end_state replacing the top by the symbols of push (first symbol on top).
+        """
+        self.transitions.setdefault((state, str(input_symbol), stack_top), []).append((end_state, tuple(push)))
+
+    def test(self, tape, max_configurations=1000000):
+        """
+        Decide whether the PDA accepts the tape (by final state, or by empty stack if accept_by_empty_stack).
+        :param max_configurations: Budget of calls and moves in progress explored over the whole tape.
+        :return: True if some branch accepts, raises ExplorationAborted if the budget runs out first.
+        """
+        tape = [str(symbol) for symbol in tape]
+        n = len(tape)
+        self.stats = {"configurations": 0, "pruned": 0, "calls": 0, "summaries": 0}
+        min_yield = self.min_yield
+        suffix_yields = {}
+
+        # a move in progress is (call, end state, push, symbols of push popped so far, state, position),
+        # the call None stands for the whole stack, with the start symbol on it
+        calls = {}          # call -> moves waiting for it to be popped
+        summaries = {}      # call -> set of (state, position) after the pop
+        seen = set()
+        pending = [(None, None, (self.stack_start_symbol,), 0, self.start_state, 0)]
+
+        def finish(call, summary):
+            # a new way to pop the top of a call, passed on to the moves waiting for it
+            if summary in summaries.setdefault(call, set()):
+                return
+            summaries[call].add(summary)
+            self.stats["summaries"] += 1
+            for waiting, end_state, push, popped, state, position in calls.get(call, ()):
+                pending.append((waiting, end_state, push, popped + 1) + summary)
+
+        while pending:
+            item = pending.pop()
+            if item in seen:
+                continue
+            call, end_state, push, popped, state, position = item
+            if popped == len(push):
+                seen.add(item)
+                finish(call, (state, position))
+                continue
+
+            rest = (push, popped)
+            if rest not in suffix_yields:
+                suffix_yields[rest] = sum(min_yield.get(symbol, 0) for symbol in push[popped:])
+            if suffix_yields[rest] > n - position:
+                self.stats["pruned"] += 1
+                continue
+            seen.add(item)
+            self.stats["configurations"] += 1
+            if self.stats["configurations"] > max_configurations:
+                self.stats["calls"] = len(calls)
+                raise ExplorationAborted("More than %d configurations at position %d of %d"
+                                         % (max_configurations, position, n), self.stats)
+
+            callee = (state, push[popped], position)
+            if callee in calls:
+                calls[callee].append(item)
+                for summary in list(summaries.get(callee, ())):
+                    pending.append((call, end_state, push, popped + 1) + summary)
+                continue
+            calls[callee] = [item]
+            for next_state, next_push in self.transitions.get((state, 'e', push[popped]), ()):
+                pending.append((callee, next_state, next_push, 0, next_state, position))
+            if position < n:
+                for next_state, next_push in self.transitions.get((state, tape[position], push[popped]), ()):
+                    pending.append((callee, next_state, next_push, 0, next_state, position + 1))
+
+        self.stats["calls"] = len(calls)
+        if self.accept_by_empty_stack:
+            return any(position == n for state, position in summaries.get(None, ()))
+        # a configuration with a non empty stack is the start of a call
+        return any(position == n and state in self.accepting_states
+                   for state, symbol, position in calls) or \
+            any(position == n and state in self.accepting_states for state, position in summaries.get(None, ()))
+
+
+# build the one state PDA that accepts the language of a grammar by empty stack
+def grammar_to_pda(productions, start=None):
+    """
+    Standard grammar to PDA construction: a nonterminal on top of the stack is replaced by one of its
+    bodies by an epsilon move, and a terminal on top is popped by reading it from the tape.
+    :param productions: List of (head, body) pairs, as returned by parse_productions.
+    :param start: Start symbol, the head of the first production by default.
+    """
+    pda = NondeterministicPDA()
+    pda.states = ["q"]
+    pda.start_state = "q"
+    pda.stack_start_symbol = start if start is not None else productions[0][0]
+    pda.accept_by_empty_stack = True
+
+    nonterminals = set(head for head, body in productions)
+    terminals = set(symbol for head, body in productions for symbol in body if symbol not in nonterminals)
+    for head, body in productions:
+        pda.add_transition("q", 'e', head, "q", body)
+    for terminal in terminals:
+        pda.add_transition("q", terminal, terminal, "q", ())
+
+    # least number of terminals each symbol derives, to a fixpoint (non-productive nonterminals stay large)
+    unproductive = 1 << 30
+    pda.min_yield = dict((terminal, 1) for terminal in terminals)
+    pda.min_yield.update((nonterminal, unproductive) for nonterminal in nonterminals)
+    changed = True
+    while changed:
+        changed = False
+        for head, body in productions:
+            body_yield = min(sum(pda.min_yield[symbol] for symbol in body), unproductive)
+            if body_yield < pda.min_yield[head]:
+                pda.min_yield[head] = body_yield
+                changed = True
+    return pda
+
+
+# convert a grammar to Chomsky normal form
+def to_cnf(productions, start=None):
+    """
+    Convert a grammar to Chomsky normal form, every body is one terminal or two nonterminals.
+    Terminals in long bodies get their own nonterminal, long bodies are split into chains of pairs
+    before the empty bodies are removed (so the grammar only grows linearly), unit bodies are
+    replaced by the bodies they reach, and bodies using nonterminals that derive nothing are dropped.
+    New nonterminals have names longer than one character, so they never clash with the symbols
+    of the grammar.
+    :param productions: List of (head, body) pairs, as returned by parse_productions.
+    :param start: Start symbol, the head of the first production by default.
+    :return: (cnf productions, start symbol, True if the grammar derives the empty string)
+    """
+    if start is None:
+        start = productions[0][0]
+    nonterminals = set(head for head, body in productions)
+
+    # terminals of long bodies and long bodies themselves
+    binary = []
+    for head, body in productions:
+        if len(body) > 1:
+            body = tuple(symbol if symbol in nonterminals else "<%s>" % symbol for symbol in body)
+            for symbol in body:
+                if symbol not in nonterminals:
+                    nonterminals.add(symbol)
+                    binary.append((symbol, (symbol[1:-1],)))
+            for n in range(len(body) - 2):
+                rest = "<%s%d>" % (head, len(binary))
+                nonterminals.add(rest)
+                binary.append((head, (body[n], rest)))
+                head = rest
+            binary.append((head, body[-2:]))
+        else:
+            binary.append((head, body))
+
+    # empty bodies, to a fixpoint
+    nullable = set()
+    changed = True
+    while changed:
+        changed = False
+        for head, body in binary:
+            if head not in nullable and all(symbol in nullable for symbol in body):
+                nullable.add(head)
+                changed = True
+    bodies = {}
+    for head, body in binary:
+        variants = [body]
+        if len(body) == 2:
+            if body[0] in nullable:
+                variants.append(body[1:])
+            if body[1] in nullable:
+                variants.append(body[:1])
+        for variant in variants:
+            if variant:
+                bodies.setdefault(head, set()).add(variant)
+
+    # unit bodies, each nonterminal takes the other bodies of every nonterminal it reaches by unit bodies
+    cnf = []
+    for head in sorted(bodies):
+        reached = set([head])
+        pending = [head]
+        while pending:
+            for body in bodies.get(pending.pop(), ()):
+                if len(body) == 1 and body[0] in nonterminals and body[0] not in reached:
+                    reached.add(body[0])
+                    pending.append(body[0])
+        for symbol in sorted(reached):
+            for body in sorted(bodies.get(symbol, ())):
+                if len(body) == 2 or body[0] not in nonterminals:
+                    cnf.append((head, body))
+
+    # bodies naming nonterminals that derive no string (such as those that were only nullable), to a fixpoint
+    generating = set()
+    changed = True
+    while changed:
+        changed = False
+        for head, body in cnf:
+            if head not in generating and (len(body) == 1 or body[0] in generating and body[1] in generating):
+                generating.add(head)
+                changed = True
+    cnf = [(head, body) for head, body in cnf if len(body) == 1 or body[0] in generating and body[1] in generating]
+    return sorted(set(cnf)), start, start in nullable
+
+
+class CYKParser(object):
+    """
+    CYK membership test with a bitset chart.
+
+    The grammar is put in Chomsky normal form and its nonterminals numbered, so a cell of the chart,
+    the nonterminals deriving one span of the tape, is a bitmask. The chart is stored by rows: for each
+    nonterminal A and start position i, ends[A][i] is the bitmask of the positions j such that A derives
+    tape[i:j]. Rows are filled from the last start position back, and within a row the spans are taken by
+    increasing end k. A binary production A -> BC with B deriving tape[i:k] then adds the whole row
+    ends[C][k] to the row of A with one OR, so all the split points of all the spans are combined a
+    machine word at a time instead of one cell at a time.
+    """
+    def __init__(self, productions, start=None):
+        """
+        :param productions: List of (head, body) pairs, as returned by parse_productions.
+        :param start: Start symbol, the head of the first production by default.
+        """
+        cnf, self.start_symbol, self.accepts_empty = to_cnf(productions, start)
+        self.nonterminals = sorted(set(head for head, body in cnf))
+        index = dict((symbol, n) for n, symbol in enumerate(self.nonterminals))
+        self.start = index.get(self.start_symbol, -1)
+
+        # terminal -> mask of the nonterminals deriving it, (B, C) -> mask of the heads of A -> BC
+        self.terminal_masks = {}
+        self.pair_masks = {}
+        for head, body in cnf:
+            if len(body) == 1:
+                self.terminal_masks[body[0]] = self.terminal_masks.get(body[0], 0) | 1 << index[head]
+            else:
+                pair = (index[body[0]], index[body[1]])
+                self.pair_masks[pair] = self.pair_masks.get(pair, 0) | 1 << index[head]
+
+        # B -> [(C, heads of A -> BC as a list)], for the left symbols of the binary productions
+        self.right_pairs = {}
+        for (left, right), heads in sorted(self.pair_masks.items()):
+            self.right_pairs.setdefault(left, []).append((right, bit_indices(heads)))
+        self.terminal_heads = dict((terminal, bit_indices(mask)) for terminal, mask in self.terminal_masks.items())
+        self.ends = None
+
+    def test(self, tape):
+        """
+        :param tape: String of terminals.
+        :return: True if the start symbol derives the tape.
+        """
+        n = len(tape)
+        if n == 0:
+            return self.accepts_empty
+        if self.start == -1:
+            return False
+        right_pairs = sorted(self.right_pairs.items())
+        ends = [[0] * n for _ in self.nonterminals]
+        for i in range(n - 1, -1, -1):
+            heads = self.terminal_heads.get(tape[i])
+            if heads is None:
+                return False
+            row = [0] * len(self.nonterminals)     # the end positions of the spans from i, by nonterminal
+            for head in heads:
+                row[head] = 1 << i + 1
+            pending = 1 << i + 1
+            while pending:
+                low = pending & -pending
+                pending ^= low
+                k = low.bit_length() - 1
+                if k == n:
+                    break
+                for left, pairs in right_pairs:
+                    if row[left] & low:
+                        for right, pair_heads in pairs:
+                            span_ends = ends[right][k]
+                            if span_ends:
+                                for head in pair_heads:
+                                    row[head] |= span_ends
+                                pending |= span_ends
+            for head, span_ends in enumerate(row):
+                ends[head][i] = span_ends
+        self.ends = ends
+        return bool(ends[self.start][0] >> n & 1)
+
+    def cell(self, i, j):
+        """
+        :return: Bitmask of the nonterminals deriving tape[i:j] of the last tape tested.
+        """
+        mask = 0
+        for head, rows in enumerate(self.ends):
+            if rows[i] >> j & 1:
+                mask |= 1 << head
+        return mask
+
+
+class ParseForest(object):
+    """
+    Shared packed parse forest of one tape, all of its parse trees with the common parts stored once.
+
+    A node is keyed by (label, i, j) for the span tape[i:j], where the label is a symbol or, for the
+    prefix body[:dot] of a production, the pair (production, dot). Terminal nodes are leaves and are not
+    stored. Each stored node maps to its packed alternatives (production, left, right): left is the node of
+    the prefix before the last symbol (None when it is empty) and right is the node of that last symbol
+    (None for an empty body), so each alternative is one way of splitting the span.
+    """
+    def __init__(self, productions, tape, root, nodes):
+        self.productions = productions
+        self.tape = tape
+        self.root = root
+        self.nodes = nodes
+
+    def __len__(self):
+        return len(self.nodes)
+
+    def packed(self, key):
+        return self.nodes.get(key, [])
+
+    def is_ambiguous(self):
+        # more than one way to split a span that is used by the forest
+        return any(len(alternatives) > 1 for alternatives in self.nodes.values())
+
+
+class EarleyParser(object):
+    """
+    Earley recognizer and parser for any grammar.
+
+    An item (production, dot, origin) is kept once per position, and each item set is indexed by the
+    symbol after the dot, so completing a nonterminal only visits the items waiting for it. Nullable
+    nonterminals are stepped over as they are predicted (Aycock and Horspool), so completions never have
+    to revisit the set they end in. Recognition uses Leo's optimization: when a completion would only
+    finish a chain of items that each end with the next (right recursion), the topmost item of the chain
+    is memoized and added directly, which keeps right recursive grammars linear. Parsing runs the same
+    item sets and builds a ParseForest afterwards, top down from the root, putting back the items of a
+    skipped chain only at the positions the forest reaches.
+    """
+    def __init__(self, productions, start=None):
+        """
+        :param productions: List of (head, body) pairs, as returned by parse_productions.
+        :param start: Start symbol, the head of the first production by default.
+        """
+        self.productions = productions
+        self.start = start if start is not None else productions[0][0]
+        self.heads = [head for head, body in productions]
+        self.bodies = [body for head, body in productions]
+        self.by_head = {}
+        for n, head in enumerate(self.heads):
+            self.by_head.setdefault(head, []).append(n)
+
+        # the augmented production (None -> start) is the one finished item of an accepted tape
+        self.accept_production = len(productions)
+        self.heads.append(None)
+        self.bodies.append((self.start,))
+
+        self.nullable = set()
+        changed = True
+        while changed:
+            changed = False
+            for head, body in productions:
+                if head not in self.nullable and all(symbol in self.nullable for symbol in body):
+                    self.nullable.add(head)
+                    changed = True
+        self.stats = None
+        self.waiting = None
+        self.leo_completions = None
+
+    def run(self, tape, leo=True):
+        """
+        Build the item sets of a tape, stopping at the first position that has none.
+        The indexes of waiting items and the completions taken by Leo's optimization at each position
+        are kept in self.waiting and self.leo_completions.
+        :return: (list of item lists, list of item sets), one of each per position reached.
+        """
+        bodies = self.bodies
+        heads = self.heads
+        by_head = self.by_head
+        nullable = self.nullable
+        n = len(tape)
+
+        item_sets = [[]]
+        seen = [set()]
+        waiting = [{}]
+        leo_items = [{}]
+        leo_completions = [[]]
+        seen[0].add((self.accept_production, 0, 0))
+        item_sets[0].append((self.accept_production, 0, 0))
+
+        def leo_top(j, symbol):
+            # topmost item of the chain of items ended by a completion of symbol from j, or None
+            path = []
+            top = None
+            while True:
+                if symbol in leo_items[j]:
+                    top = leo_items[j][symbol] or top
+                    break
+                items = waiting[j].get(symbol)
+                if items is None or len(items) != 1 or items[0][1] + 1 != len(bodies[items[0][0]]):
+                    leo_items[j][symbol] = None
+                    break
+                production, dot, origin = items[0]
+                path.append((j, symbol))
+                top = (production, dot + 1, origin)
+                j, symbol = origin, heads[production]
+            for j, symbol in path:
+                leo_items[j][symbol] = top
+            return top
+
+        for i in range(n + 1):
+            items = item_sets[i]
+            current = seen[i]
+            index = waiting[i]
+            if i < n:
+                item_sets.append([])
+                seen.append(set())
+                waiting.append({})
+                leo_items.append({})
+                leo_completions.append([])
+            predicted = set()
+            k = 0
+            while k < len(items):
+                production, dot, origin = items[k]
+                k += 1
+                body = bodies[production]
+                if dot < len(body):
+                    symbol = body[dot]
+                    if symbol in by_head:
+                        index.setdefault(symbol, []).append((production, dot, origin))
+                        if symbol not in predicted:
+                            predicted.add(symbol)
+                            for predicted_production in by_head[symbol]:
+                                item = (predicted_production, 0, i)
+                                if item not in current:
+                                    current.add(item)
+                                    items.append(item)
+                        if symbol in nullable:
+                            item = (production, dot + 1, origin)
+                            if item not in current:
+                                current.add(item)
+                                items.append(item)
+                    elif i < n and tape[i] == symbol:
+                        item = (production, dot + 1, origin)
+                        if item not in seen[i + 1]:
+                            seen[i + 1].add(item)
+                            item_sets[i + 1].append(item)
+                elif origin != i:
+                    # empty completions are covered by stepping over nullable symbols
+                    head = heads[production]
+                    top = leo_top(origin, head) if leo else None
+                    if top is not None:
+                        leo_completions[i].append((origin, head))
+                        completed = [top]
+                    else:
+                        completed = [(p, d + 1, o) for p, d, o in waiting[origin].get(head, ())]
+                    for item in completed:
+                        if item not in current:
+                            current.add(item)
+                            items.append(item)
+            if i < n and not item_sets[i + 1]:
+                break
+
+        self.stats = {"items": sum(len(items) for items in item_sets), "positions": len(item_sets)}
+        self.waiting = waiting
+        self.leo_completions = leo_completions
+        return item_sets, seen
+
+    def accepts(self, seen, n):
+        return len(seen) == n + 1 and (self.accept_production, 1, 0) in seen[n]
+
+    def test(self, tape):
+        """
+        :param tape: String of terminals.
+        :return: True if the start symbol derives the tape.
+        """
+        item_sets, seen = self.run(tape)
+        return self.accepts(seen, len(tape))
+
+    def parse(self, tape):
+        """
+        :param tape: String of terminals.
+        :return: ParseForest of the tape, or None if it is rejected.
+        """
+        n = len(tape)
+        item_sets, seen = self.run(tape)
+        if not self.accepts(seen, n):
+            return None
+        heads = self.heads
+        bodies = self.bodies
+        waiting = self.waiting
+        leo_completions = self.leo_completions
+
+        # unfinished item -> positions it is in (unfinished items are never skipped by Leo's optimization)
+        positions = {}
+        for k, items in enumerate(item_sets):
+            for production, dot, origin in items:
+                if 0 < dot < len(bodies[production]):
+                    positions.setdefault((production, dot, origin), set()).add(k)
+
+        # position j -> symbol -> origins of its finished items, with the skipped chains put back on first use
+        origins = {}
+
+        def finished(j):
+            if j not in origins:
+                current = seen[j]
+                for origin, symbol in leo_completions[j]:
+                    while True:
+                        production, dot, origin = waiting[origin][symbol][0]
+                        item = (production, dot + 1, origin)
+                        if item in current:
+                            break
+                        current.add(item)
+                        symbol = heads[production]
+                ends = {}
+                for production, dot, origin in current:
+                    if dot == len(bodies[production]):
+                        ends.setdefault(heads[production], set()).add(origin)
+                origins[j] = ends
+            return origins[j]
+
+        def splits(production, dot, i, j):
+            # (left, right) pairs of the ways body[:dot] derives tape[i:j]
+            if dot == 0:
+                return [(None, None)] if i == j else []
+            symbol = bodies[production][dot - 1]
+            if symbol not in self.by_head:
+                middles = [j - 1] if i < j and tape[j - 1] == symbol else []
+            else:
+                middles = finished(j).get(symbol, set())
+            if dot == 1:
+                middles = [i] if i in middles else []
+            else:
+                # the smaller of the two position sets drives the search
+                lefts = positions.get((production, dot - 1, i), set())
+                if len(lefts) < len(middles):
+                    middles = [k for k in lefts if k in middles]
+                else:
+                    middles = [k for k in middles if k in lefts]
+            pairs = []
+            for k in sorted(middles):
+                left = ((production, dot - 1), i, k) if dot > 1 else None
+                pairs.append((left, (symbol, k, j)))
+            return pairs
+
+        root = (self.start, 0, n)
+        nodes = {}
+        pending = [root]
+        while pending:
+            key = pending.pop()
+            if key in nodes:
+                continue
+            label, i, j = key
+            if isinstance(label, tuple):
+                alternatives = [(label[0], left, right) for left, right in splits(label[0], label[1], i, j)]
+            else:
+                alternatives = []
+                ends = finished(j)
+                if i in ends.get(label, ()):
+                    for production in self.by_head[label]:
+                        if (production, len(bodies[production]), i) in seen[j]:
+                            alternatives.extend((production, left, right)
+                                                for left, right in splits(production, len(bodies[production]), i, j))
+            nodes[key] = alternatives
+            for production, left, right in alternatives:
+                if left is not None and left not in nodes:
+                    pending.append(left)
+                if right is not None and right[0] in self.by_head and right not in nodes:
+                    pending.append(right)
+        return ParseForest(self.productions, tape, root, nodes)
+
+
+class NondeterministicGrammar(Exception):
+    """
+    Raised by compile_grammar when a grammar is neither LL(1) nor LALR(1), report holds the conflicts of both.
+    """
+    def __init__(self, message, report):
+        super(NondeterministicGrammar, self).__init__(message)
+        self.report = report
+
+
+class DeterministicParser(object):
+    """
+    Common part of the table driven parsers: symbol numbering and the FIRST and FOLLOW sets.
+
+    Terminals are numbered 0 to T - 1, the end of the tape is T and nonterminal k is T + 1 + k, so that
+    a parser stack is a flat array of ints. In conflict reports the end of the tape is written "$".
+    """
+    def __init__(self, productions, start=None):
+        """
+        :param productions: List of (head, body) pairs, as returned by parse_productions.
+        :param start: Start symbol, the head of the first production by default.
+        """
+        self.productions = productions
+        self.start = start if start is not None else productions[0][0]
+        self.nonterminals = []
+        for head, body in productions:
+            if head not in self.nonterminals:
+                self.nonterminals.append(head)
+        if self.start in self.nonterminals:
+            self.nonterminals.remove(self.start)
+        self.nonterminals.insert(0, self.start)
+        self.terminals = sorted(set(symbol for head, body in productions for symbol in body
+                                    if symbol not in self.nonterminals))
+        self.end = len(self.terminals)
+        self.codes = dict((symbol, n) for n, symbol in enumerate(self.terminals))
+        self.codes.update((symbol, self.end + 1 + n) for n, symbol in enumerate(self.nonterminals))
+        self.heads = [self.codes[head] - self.end - 1 for head, body in productions]
+        self.bodies = [tuple(self.codes[symbol] for symbol in body) for head, body in productions]
+        self.conflicts = []
+
+        # FIRST of each nonterminal and the nullable ones, to a fixpoint
+        self.nullable = set()
+        self.first = dict((n, set()) for n in range(len(self.nonterminals)))
+        changed = True
+        while changed:
+            changed = False
+            for head, body in zip(self.heads, self.bodies):
+                first, nullable = self.first_of(body)
+                if not first <= self.first[head]:
+                    self.first[head] |= first
+                    changed = True
+                if nullable and head not in self.nullable:
+                    self.nullable.add(head)
+                    changed = True
+
+        # FOLLOW of each nonterminal, the end of the tape follows the start symbol
+        self.follow = dict((n, set()) for n in range(len(self.nonterminals)))
+        self.follow[0].add(self.end)
+        changed = True
+        while changed:
+            changed = False
+            for head, body in zip(self.heads, self.bodies):
+                for n, symbol in enumerate(body):
+                    if symbol > self.end:
+                        first, nullable = self.first_of(body[n + 1:])
+                        if nullable:
+                            first = first | self.follow[head]
+                        if not first <= self.follow[symbol - self.end - 1]:
+                            self.follow[symbol - self.end - 1] |= first
+                            changed = True
+
+    def first_of(self, symbols):
+        # (terminals that can start the sequence, True if it derives the empty string)
+        first = set()
+        for symbol in symbols:
+            if symbol < self.end:
+                first.add(symbol)
+                return first, False
+            first |= self.first[symbol - self.end - 1]
+            if symbol - self.end - 1 not in self.nullable:
+                return first, False
+        return first, True
+
+    def symbol_name(self, code):
+        if code == self.end:
+            return "$"
+        if code < self.end:
+            return self.terminals[code]
+        return self.nonterminals[code - self.end - 1]
+
+    def encode(self, tape):
+        # the terminal codes of a tape followed by the end marker, or None if it has other symbols
+        try:
+            codes = [self.codes[symbol] for symbol in tape]
+        except KeyError:
+            return None
+        if any(code > self.end for code in codes):
+            return None
+        codes.append(self.end)
+        return codes
+
+
+class LLParser(DeterministicParser):
+    """
+    LL(1) parser: a table from (nonterminal, next terminal) to the production to expand.
+    The table is a flat array with a row per nonterminal, -1 for no production, and the stack holds
+    symbol codes. A cell claimed by two productions is a conflict, the first production keeps it.
+    """
+    def __init__(self, productions, start=None):
+        super(LLParser, self).__init__(productions, start)
+        width = self.end + 1
+        self.table = array('i', [-1]) * (len(self.nonterminals) * width)
+        for production, (head, body) in enumerate(zip(self.heads, self.bodies)):
+            lookaheads, nullable = self.first_of(body)
+            if nullable:
+                lookaheads = lookaheads | self.follow[head]
+            for terminal in sorted(lookaheads):
+                cell = head * width + terminal
+                if self.table[cell] == -1:
+                    self.table[cell] = production
+                elif self.table[cell] != production:
+                    self.conflicts.append({"nonterminal": self.nonterminals[head],
+                                           "terminal": self.symbol_name(terminal),
+                                           "productions": [productions[self.table[cell]], productions[production]]})
+        # bodies reversed, to be pushed with the first symbol on top
+        self.pushes = [array('i', reversed(body)) for body in self.bodies]
+
+    def test(self, tape):
+        """
+        :param tape: String of terminals.
+        :return: True if the start symbol derives the tape.
+        """
+        codes = self.encode(tape)
+        if codes is None:
+            return False
+        end = self.end
+        width = end + 1
+        table = self.table
+        pushes = self.pushes
+        stack = array('i', [end, end + 1])
+        i = 0
+        while True:
+            top = stack.pop()
+            if top < end:
+                if top != codes[i]:
+                    return False
+                i += 1
+            elif top == end:
+                return codes[i] == end
+            else:
+                production = table[(top - end - 1) * width + codes[i]]
+                if production == -1:
+                    return False
+                stack.extend(pushes[production])
+
+
+class LALRParser(DeterministicParser):
+    """
+    LALR(1) parser, built from the canonical LR(1) automaton by merging the states with the same core.
+
+    The action table is a flat array with a row per state: 0 is an error, s + 1 shifts and goes to state s,
+    and -(p + 1) reduces by production p (accepting for the augmented production, number len(productions)).
+    The goto table has a row per state and a column per nonterminal, -1 for none. Shift/reduce conflicts
+    are resolved as shifts and reduce/reduce conflicts for the first production, and all are recorded.
+    """
+    def __init__(self, productions, start=None):
+        super(LALRParser, self).__init__(productions, start)
+        end = self.end
+        accept = len(productions)
+        bodies = self.bodies + [(end + 1,)]
+        by_head = {}
+        for production, head in enumerate(self.heads):
+            by_head.setdefault(head, []).append(production)
+
+        def closure(items):
+            items = set(items)
+            pending = list(items)
+            while pending:
+                production, dot, lookahead = pending.pop()
+                body = bodies[production]
+                if dot < len(body) and body[dot] > end:
+                    lookaheads, nullable = self.first_of(body[dot + 1:])
+                    if nullable:
+                        lookaheads.add(lookahead)
+                    for expansion in by_head.get(body[dot] - end - 1, ()):
+                        for terminal in lookaheads:
+                            item = (expansion, 0, terminal)
+                            if item not in items:
+                                items.add(item)
+                                pending.append(item)
+            return frozenset(items)
+
+        # canonical LR(1) states, then their cores numbered in order of discovery
+        states = [closure([(accept, 0, end)])]
+        state_ids = {states[0]: 0}
+        transitions = []
+        k = 0
+        while k < len(states):
+            kernels = {}
+            for production, dot, lookahead in states[k]:
+                body = bodies[production]
+                if dot < len(body):
+                    kernels.setdefault(body[dot], []).append((production, dot + 1, lookahead))
+            moves = {}
+            for symbol, kernel in kernels.items():
+                target = closure(kernel)
+                if target not in state_ids:
+                    state_ids[target] = len(states)
+                    states.append(target)
+                moves[symbol] = state_ids[target]
+            transitions.append(moves)
+            k += 1
+
+        core_ids = {}
+        merged = []
+        for items in states:
+            core = frozenset((production, dot) for production, dot, lookahead in items)
+            if core not in core_ids:
+                core_ids[core] = len(merged)
+                merged.append(set())
+            merged[core_ids[core]] |= items
+        state_of = [core_ids[frozenset((production, dot) for production, dot, lookahead in items)] for items in states]
+
+        width = end + 1
+        self.state_count = len(merged)
+        self.action = array('i', [0]) * (self.state_count * width)
+        self.goto = array('i', [-1]) * (self.state_count * len(self.nonterminals))
+        for canonical, moves in enumerate(transitions):
+            state = state_of[canonical]
+            for symbol, target in moves.items():
+                if symbol > end:
+                    self.goto[state * len(self.nonterminals) + symbol - end - 1] = state_of[target]
+                else:
+                    self.action[state * width + symbol] = state_of[target] + 1
+        for state, items in enumerate(merged):
+            for production, dot, lookahead in sorted(items):
+                if dot != len(bodies[production]):
+                    continue
+                cell = state * width + lookahead
+                current = self.action[cell]
+                if current == 0:
+                    self.action[cell] = -(production + 1)
+                elif current != -(production + 1):
+                    kind = "shift/reduce" if current > 0 else "reduce/reduce"
+                    self.conflicts.append({"state": state, "terminal": self.symbol_name(lookahead), "type": kind,
+                                           "productions": [self.production_name(production)] if current > 0 else
+                                           [self.production_name(-current - 1), self.production_name(production)]})
+        self.lengths = array('i', [len(body) for body in bodies])
+        self.goto_heads = array('i', self.heads + [0])
+
+    def production_name(self, production):
+        # the (head, body) of a production, the augmented production is (None, (start,))
+        if production == len(self.productions):
+            return None, (self.start,)
+        return self.productions[production]
+
+    def test(self, tape):
+        """
+        :param tape: String of terminals.
+        :return: True if the start symbol derives the tape.
+        """
+        codes = self.encode(tape)
+        if codes is None:
+            return False
+        width = self.end + 1
+        nonterminal_count = len(self.nonterminals)
+        accept = -(len(self.productions) + 1)
+        action = self.action
+        goto = self.goto
+        lengths = self.lengths
+        goto_heads = self.goto_heads
+        stack = array('i', [0])
+        i = 0
+        while True:
+            move = action[stack[-1] * width + codes[i]]
+            if move > 0:
+                stack.append(move - 1)
+                i += 1
+            elif move == accept:
+                return True
+            elif move < 0:
+                production = -move - 1
+                if lengths[production]:
+                    del stack[-lengths[production]:]
+                stack.append(goto[stack[-1] * nonterminal_count + goto_heads[production]])
+            else:
+                return False
+
+
+# returns a table driven parser for a deterministic grammar, trying LL(1) before LALR(1)
+def compile_grammar(productions, start=None):
+    """
+    :param productions: List of (head, body) pairs, as returned by parse_productions.
+    :param start: Start symbol, the head of the first production by default.
+    :return: LLParser or LALRParser without conflicts.
+    :raises NondeterministicGrammar: if both have conflicts.
+    """
+    ll_parser = LLParser(productions, start)
+    if not ll_parser.conflicts:
+        return ll_parser
+    lalr_parser = LALRParser(productions, start)
+    if not lalr_parser.conflicts:
+        return lalr_parser
+    raise NondeterministicGrammar("grammar is neither LL(1) nor LALR(1)",
+                                  {"ll1": ll_parser.conflicts, "lalr1": lalr_parser.conflicts})
+
+
 class TuringMachine(DFA):
     def __init__(self):
         super(TuringMachine, self).__init__()
@@ -435,25 +2941,6 @@ class TuringMachine(DFA):
         return False
 
 
-# define helper class for tree structure
-class Node(object):
-    def __init__(self, current_state, parent=None):
-        self.state = current_state  # the state of this node (from dictionary)
-        self.children = []  # list of children for this node
-        self.transition = None
-        self.transition_number = None
-        self.parent = parent
-
-    def set_transition(self, trans, number):
-        self.transition = trans
-        self.transition_number = number
-
-    def add_child(self, obj):
-        # if self.transition == 'e':
-        #  print "added child "+obj.state
-        self.children.append(obj)
-
-
 # returns the set from string applying type function
 def parse_to_set(string, typecast):
     _set = []
@@ -494,6 +2981,26 @@ def parse_transition_string(string, sigma, strict=strict):
     return _set
 
 
+# parses the productions of a "cfg" string such as [(S, AB, BC), (A, BA, a)] into (head, body) pairs
+def parse_productions(cfg_string):
+    """
+    Return the list of productions of a grammar, the first symbol of each tuple is the head and
+    every following entry is one body for it (S -> AB | BC above).
+    Bodies are read one character per symbol, and a body of e is the empty body.
+    :param cfg_string: Grammar string from the "cfg" entry of a machine file.
+    :return: List of (head, body) with body a tuple of symbols, the start symbol is the first head.
+    """
+    productions = []
+    for language in re.findall('\(.*?\)', cfg_string):
+        lang = language.split(",")
+        lang[0] = lang[0][1:]
+        lang[-1] = lang[-1][:-1]
+        lang = [i.strip() for i in lang if i.strip() != ""]
+        for body in lang[1:]:
+            productions.append((lang[0], () if body == "e" else tuple(body)))
+    return productions
+
+
 # parses the delta transitions from string to table
 def parse_delta_table(delta_string, sigma_set, state_set):
     delta_table = {}
@@ -580,17 +3087,43 @@ def read_file(filename):
                 else:
                     print "FAILS"
         elif type == "cfg":
-            cfg = PushDownAutomata()
-            data = data["cfg"]
-            x = 0
-            for language in re.findall('\(.*?\)', cfg):
-                lang = language.split(",")
-                lang[0] = lang[0][1:]
-                lang[-1] = lang[-1][:-1]
-                lang = [i.strip() for i in lang if i != " "]
-                cfg.add_rule(lang[2], lang[0], x, lang[1])
-                x += 1
+            productions = parse_productions(data["cfg"])
             # do testing on cfg file
+            try:
+                tape = data["test"]
+            except KeyError:
+                tape = None
+            if tape is not None:
+                parser = data.get("parser", "cyk")
+                if parser == "pda":
+                    try:
+                        accepted = grammar_to_pda(productions).test(tape)
+                    except ExplorationAborted as error:
+                        print error
+                        pprint(error.report)
+                        accepted = None
+                elif parser == "deterministic":
+                    try:
+                        accepted = compile_grammar(productions).test(tape)
+                    except NondeterministicGrammar as error:
+                        print error
+                        pprint(error.report)
+                        accepted = EarleyParser(productions).test(tape)
+                elif parser == "earley":
+                    earley = EarleyParser(productions)
+                    if data.get("forest"):
+                        forest = earley.parse(tape)
+                        accepted = forest is not None
+                        if accepted:
+                            pprint(forest.nodes)
+                    else:
+                        accepted = earley.test(tape)
+                else:
+                    accepted = CYKParser(productions).test(tape)
+                if accepted:
+                    print "PASSES"
+                elif accepted is not None:
+                    print "FAILS"
         elif type == "turing":
             print "created turing machine"
             tm = TuringMachine()
@@ -675,8 +3208,13 @@ def read_file(filename):
 
 
 # return whether or not the transition string lands in accepting state
-def test_query(transitions, states, q, f, delta, sigma):
-
+def test_query(transitions, states, q, f, delta, sigma, trace=False):
+    """
+    Run the tape through the (epsilon) NFA given by its delta table, one deduplicated frontier of states per step.
+    :param trace: If True, record for every step an array giving, for each state reached, the state it came from.
+    :return: (accepted, trace, fringe) where trace is the list of parent arrays (None unless tracing)
+             and fringe the list of states the tape ended in.
+    """
     if verbose:
         print "Transition string:\t",
 
@@ -684,105 +3222,55 @@ def test_query(transitions, states, q, f, delta, sigma):
 
         print ""
 
-    fringe = []
-    head = Node(str(q))
-    fringe.append(head)
+    index = dict((s, i) for i, s in enumerate(states))
+    closures = [bit_indices(closure) for closure in epsilon_closures(states, delta)]
 
-    paths_taken = {}
+    # the frontier holds each state at most once, seen marks the states already in the next frontier
+    fringe = closures[index[q]]
+    seen = bytearray(len(states))
+    parents = [] if trace else None
+    if trace:
+        parents.append(array('i', [-1]) * len(states))
 
     # for all transitions in string
-    for i in range(len(transitions)):
-
-        # start a fringe for children nodes to process next
+    for transition in transitions:
+        transition = str(transition)
         new_fringe = []
-
-        # maintain fringe for delta transitions to avoid looping
-        delta_fringe = []
-
-        for node in fringe:
-            # create node in path structure
-            if node.state not in paths_taken:
-                paths_taken[node.state] = {}
-
-            next_states = delta[node.state][str(transitions[i])][:]
-            # get states from transition
-
-            if 'e' not in paths_taken[node.state]:
-                paths_taken[node.state]['e'] = {}
-            # get states from delta + transition
-            for epsilon in delta[node.state]['e']:
-                epsilon_state = Node(str(epsilon), node.parent)
-                epsilon_state.set_transition('e', i-1)
-
-                # if we have already taken the epsilon transition in the past
-                if epsilon in paths_taken[node.state]['e']:
-                    pass
-                else:
-                    paths_taken[node.state]['e'][str(epsilon)] = len(next_states) + 1
-                if node.parent is not None:
-                    node.parent.add_child(epsilon_state)
-                else:
-                    head.add_child(epsilon_state)
-                # print "Did epsilon from "+node.state+" to "+epsilon_state.state
-                _nStates = delta[epsilon_state.state][str(transitions[i])][:]
-                for s in _nStates:
-                    child = Node(str(s), epsilon_state)
-                    child.set_transition(transitions[i], i)
-                    epsilon_state.add_child(child)
-                    new_fringe.append(child)
-
-            for nState in next_states:
-                child_node = Node(str(nState), node)
-                child_node.set_transition(transitions[i], i)
-                node.add_child(child_node)
-                new_fringe.append(child_node)
-                if transitions[i] not in paths_taken[node.state]:
-                    paths_taken[node.state][str(transitions[i])] = {}
-                paths_taken[node.state][str(transitions[i])][child_node.state] = 1
-
-            # reset our next states
-            next_states = []
-
-        # clear fringe and update
-        del fringe[:]
+        if trace:
+            parent = array('i', [-1]) * len(states)
+            parents.append(parent)
+
+        for s in fringe:
+            for end_state in delta[states[s]].get(transition, []):
+                for t in closures[index[end_state]]:
+                    if not seen[t]:
+                        seen[t] = 1
+                        new_fringe.append(t)
+                        if trace:
+                            parent[t] = s
+
+        for t in new_fringe:
+            seen[t] = 0
         fringe = new_fringe
 
-        # if verbose:
-        # print "State Trace\n"
-        # recursive print on head node
-        # print_node(head)
-
-    # iterate over the final states for NFA
-    for node in fringe:
-        # check if it is in the accepting states
-        if node.state in f:
-            return True, paths_taken, fringe
-    # if none of the final states are in accepting states
-    return False, paths_taken, fringe
-
-
-# recursive print function to print tree
-def print_node(node):
-    if node.transitionNumber > 0:
-        transition_number = node.transitionNumber
-        print "    "*transition_number,
-        print "-"+str(node.transition)+"->",
-    else:
-        print " ",
-
-    # process the children
-    for child in node.children:
-        if child.children and child.transition == 'e':
-            print_node(child)
-        elif child.transition != 'e':
-            print_node(child)
-
-
-def in_fringe(find_state, fringe):
+    fringe = [states[s] for s in fringe]
+    # check if any of the final states is in the accepting states
     for s in fringe:
-        if s.state == find_state:
-            return True
-    return False
+        if s in f:
+            return True, parents, fringe
+    # if none of the final states are in accepting states
+    return False, parents, fringe
+
+
+# read back the states passed through to reach a final state, from the trace of test_query
+def trace_path(trace, states, final_state):
+    path = [final_state]
+    s = states.index(final_state)
+    for parent in reversed(trace[1:]):
+        s = parent[s]
+        path.append(states[s])
+    path.reverse()
+    return path
 
 
 def process_file(filename):
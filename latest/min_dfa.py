@@ -13,6 +13,8 @@ import re
 import json
 from pprint import pprint
 
+from machines import DFA
+
 # define global variables
 verbose = False
 
@@ -121,41 +123,14 @@ def table_fill(state_list, f, delta_table, sigma):
     if verbose:
         print '\n==============================\n'
 
-    # create our list of marked pairs (distinguishable)
-    marked = []
-
-    # create a list of state pairs for our table-filling algorithm
-    pairs = []
-    for p in state_list:
-        for q in state_list:
-            if q != p:
-                if (q, p) not in pairs and (p, q) not in pairs:
-                    # if the state goes to accepting state it must be marked
-                    if p in f or q in f:
-                        marked.append((p, q))
-                    else:
-                        pairs.append((p, q))
-
-    # create a list of indistinguishable nodes by listing all pairs and removing the marked ones as we find them
-    indistinguishable_pairs = pairs[:]
-
-    # algorithm requires that this be run twice
-    for i in range(2):
-        for p, q in pairs:
-            for transition in sigma:
-                r = delta_table[p][str(transition)]
-                s = delta_table[q][str(transition)]
-                if r != [] and s != []:
-                    r = r[0]
-                    s = s[0]
-                    if s < r:
-                        _t = s
-                        s = r
-                        r = _t
-                    if (r, s) in marked:
-                        if (p, q) not in marked:
-                            marked.append((p, q))
-                            indistinguishable_pairs.remove((p, q))
+    dfa = DFA()
+    dfa.states = state_list
+    dfa.input_symbols = sigma
+    dfa.accepting_states = f
+    dfa.delta_transition_table = delta_table
+    dfa.start_state = state_list[0]     # any state will do, the table covers every pair of states
+
+    indistinguishable_pairs = dfa.table_fill()
 
     if verbose:
         print "Indistinguishable Pairs:", indistinguishable_pairs
@@ -205,53 +180,36 @@ def process_file(filename):
         print_delta_table(_delta, _sigma)
 
     remappings = table_fill(_states, _f, _delta, _sigma)
-    removed = []
-
-    for x, deleted_node in remappings:
-        removed.append(deleted_node)
-
-    for merge_node, removed_node in remappings:
-        _delta.pop(removed_node)
-        preserved_node_for_merging = _delta.pop(merge_node)
-           
-        _delta[merge_node+removed_node] = preserved_node_for_merging
-
-        # combine both nodes into a new node
-        for start_node in _delta.keys():
-            for transition in _delta[start_node]:
-                if removed_node in _delta[start_node][transition]:
-                    _delta[start_node][transition].remove(removed_node)
-                    _delta[start_node][transition].append(merge_node)
-    
-    for start in _delta:    
-        # rename all transitions to old nodes to merged node
-        for transition in _delta[start]:
-            dest_node_list = _delta[start][transition]
-            for m, r in remappings:
-                if m in dest_node_list:
-                    dest_node_list.remove(m)
-                    dest_node_list.append(m+r)
-                if r in dest_node_list:
-                    dest_node_list.remove(r)
-                    dest_node_list.append(m+r)
-        
+
+    dfa = DFA()
+    dfa.states = _states
+    dfa.input_symbols = _sigma
+    dfa.start_state = _q
+    dfa.accepting_states = _f
+    dfa.delta_transition_table = _delta
+
+    # merge the equivalent states, naming each merged node after all of the nodes it combines
+    reduced, classes = dfa.quotient(remappings)
+    merged_names = dict((s, ''.join(classes[s])) for s in reduced.states)
+
+    _delta = {}
+    for start_node in reduced.states:
+        _delta[merged_names[start_node]] = {}
+        for transition, dest_node_list in reduced.delta_transition_table[start_node].iteritems():
+            _delta[merged_names[start_node]][transition] = [merged_names[m] for m in dest_node_list]
+
     if verbose:
         print "Reduced Delta Table"
         print_delta_table(_delta, _sigma)
 
     # rename our starting state if it was changed
-    for m, r in remappings:
-        if _q == m or _q == r:
-            _q = m+r
+    _q = merged_names[reduced.start_state]
 
     # rename accepting states
     accepting_states = ''
-    for s in _f:
-        for m, r in remappings:
-            if s == m or s == r:
-                s = m+r
-            accepting_states = accepting_states + " " + str(s)
- 
+    for s in reduced.accepting_states:
+        accepting_states = accepting_states + " " + merged_names[s]
+
     digraph = """digraph finite_state_machine {
   rankdir=LR;
   size="8,5"